@@ -0,0 +1,2 @@
+from .synthetic import sample_social_graph, write_synthetic_dataset
+from .timing import StageTimer, StepTimer
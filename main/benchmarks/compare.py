@@ -0,0 +1,59 @@
+import argparse
+from pathlib import Path
+
+from utils.io import load_json_file
+
+
+def compare_results(baseline, candidate, threshold: float = 0.10):
+    """
+    Compares the median time of every stage in two benchmark results. Stages
+    more than `threshold` slower than the baseline are flagged as regressions.
+
+    """
+    rows = []
+    for stage in baseline["stages"].keys() | candidate["stages"].keys():
+        if stage not in baseline["stages"] or stage not in candidate["stages"]:
+            rows.append((stage, None, None, None, "missing"))
+            continue
+
+        baseline_time = baseline["stages"][stage]["median"]
+        candidate_time = candidate["stages"][stage]["median"]
+        ratio = candidate_time / baseline_time
+
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = ""
+
+        rows.append((stage, baseline_time, candidate_time, ratio, status))
+
+    return sorted(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare two benchmark result files stage by stage."
+    )
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("candidate", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.10)
+    cmd_args = parser.parse_args()
+
+    baseline = load_json_file(cmd_args.baseline)
+    candidate = load_json_file(cmd_args.candidate)
+
+    print(f"Baseline:  {baseline['commit']} ({baseline['timestamp']})")
+    print(f"Candidate: {candidate['commit']} ({candidate['timestamp']})\n")
+
+    for stage, baseline_time, candidate_time, ratio, status in compare_results(
+        baseline, candidate, threshold=cmd_args.threshold
+    ):
+        if ratio is None:
+            print(f"{stage:<32} {status}")
+        else:
+            print(
+                f"{stage:<32} {baseline_time:9.4f}s -> {candidate_time:9.4f}s"
+                f" ({ratio:5.2f}x) {status}"
+            )
@@ -0,0 +1,348 @@
+import os
+import shutil
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader
+from lightning_lite.utilities.seed import seed_everything
+
+from data_prep.graph_io import GraphIO, ARTIFACT_CACHE
+from data_prep.graph_processing import GraphProcessor
+from data_loading import get_dataset
+from models import GatMAML, GatPrototypical
+from models.sparse_gat import SparseGATLayer
+from benchmarks.synthetic import sample_social_graph, write_synthetic_dataset
+from benchmarks.timing import StageTimer, StepTimer
+from utils.io import save_json_file, create_dir, np_converter
+
+os.environ["HYDRA_FULL_ERROR"] = "1"
+
+# Structuring stages, in the order `preprocess.py` runs them
+STRUCTURE_STAGES = ["prep", "build_graph", "split_graph", "generate_batches"]
+
+META_LEARNERS = {
+    "maml": GatMAML,
+    "protomaml": GatPrototypical,
+}
+
+
+def print_step(string):
+    print("\n" + "=" * 100)
+    print(f"{string.upper():^100s}")
+    print("=" * 100 + "\n")
+
+
+def get_git_commit():
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.stdout.strip()
+
+
+def clear_caches(args):
+    # Both the content-hashed results on disk and the loaded artifacts in memory
+    graph_io = GraphIO(args["data"], version=args["version"], enforce_raw=False)
+    shutil.rmtree(graph_io.data_processed_path("cache"), ignore_errors=True)
+
+    ARTIFACT_CACHE.clear()
+
+
+def run_structure_stage(dataset, stage, args):
+    if stage == "generate_batches":
+        dataset.partition_into_batches()
+        dataset.generate_batches(num_workers=args["structure"]["num_workers"])
+    else:
+        getattr(dataset, stage)()
+
+    return dataset
+
+
+def prepare_dataset(args, stage):
+    """
+    A new training split dataset, with all structuring stages before `stage`
+    already run.
+
+    """
+    if args["benchmark"]["cold_cache"]:
+        clear_caches(args)
+
+    dataset = get_dataset(args, "train", load=False)
+
+    for prev_stage in STRUCTURE_STAGES[: STRUCTURE_STAGES.index(stage)]:
+        run_structure_stage(dataset, prev_stage, args)
+
+    return dataset
+
+
+def benchmark_structuring(args, timer):
+    bench_args = args["benchmark"]
+
+    # Graph processing =========================================================
+    print_step("benchmarking graph processing")
+    graph_processor = GraphProcessor(
+        args["data"], version=args["version"], overwrite=True, enforce_raw=False
+    )
+
+    timer.time(
+        "generate_adjacency_matrix",
+        lambda _: graph_processor.generate_adjacency_matrix(),
+        repeats=bench_args["repeats"],
+        setup=lambda: clear_caches(args) if bench_args["cold_cache"] else None,
+        items=lambda _: graph_processor.load_file("adj_matrix").nnz,
+    )
+
+    # Structuring ==============================================================
+    for stage in STRUCTURE_STAGES[1:]:
+        print_step(f"benchmarking {stage}")
+
+        dataset = timer.time(
+            stage,
+            partial(run_structure_stage, stage=stage, args=args),
+            repeats=bench_args["repeats"],
+            setup=partial(prepare_dataset, args, stage),
+        )
+
+    # The last dataset is fully structured
+    return dataset
+
+
+def benchmark_sampling(args, timer, dataset):
+    bench_args = args["benchmark"]
+
+    # Support subgraphs ========================================================
+    print_step("benchmarking generate_subgraph")
+    support_dataset = dataset.support_graph_dataset
+
+    central_nodes = [
+        (node_id, cluster_id)
+        for cluster_id, cluster in enumerate(support_dataset.clusters)
+        for node_id in cluster
+    ][: bench_args["num_subgraphs"]]
+
+    def generate_subgraphs(rng):
+        support_dataset.rng = rng
+
+        return [
+            support_dataset.generate_subgraph(node_id, cluster_id)
+            for node_id, cluster_id in central_nodes
+        ]
+
+    timer.time(
+        "generate_subgraph",
+        generate_subgraphs,
+        repeats=bench_args["repeats"],
+        setup=lambda: torch.Generator().manual_seed(args["seed"]),
+        items=len(central_nodes),
+    )
+
+    # Only the batched subgraphs are kept by `generate_batches`
+    del support_dataset.rng
+    for node_id, _ in central_nodes:
+        (support_dataset.neighbourhood_dir / f"subgraph_{node_id}.pt").unlink(
+            missing_ok=True
+        )
+
+    # Episodes =================================================================
+    print_step("benchmarking collate_fn_train")
+    episodes = list(islice(iter(dataset), bench_args["num_episodes"]))
+
+    timer.time(
+        "collate_fn_train",
+        lambda: [dataset.collate_fn_train([episode]) for episode in episodes],
+        repeats=bench_args["repeats"],
+        items=len(episodes),
+    )
+
+
+def benchmark_model(args, timer, dataset):
+    bench_args = args["benchmark"]
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # A single attention layer, over the full graph ============================
+    print_step("benchmarking SparseGATLayer.forward")
+    layer = SparseGATLayer(
+        in_features=bench_args["feature_dim"],
+        out_features=args["model"]["hid_dim"],
+        attn_drop=args["model"]["attn_dropout"],
+    )
+    layer = layer.to(device).eval()
+
+    x = dataset.graph.x.float().to(device)
+    edge_index = dataset.graph.edge_index.to(device)
+
+    with torch.no_grad():
+        timer.time(
+            "SparseGATLayer.forward",
+            lambda: layer(x, edge_index),
+            repeats=bench_args["repeats"],
+            warmup=1,
+            items=edge_index.shape[1],
+        )
+
+    # Full meta-learning steps =================================================
+    args["model"]["input_dim"] = bench_args["feature_dim"]
+
+    for meta_learner, model_cls in META_LEARNERS.items():
+        print_step(f"benchmarking {meta_learner} step")
+
+        model = model_cls(
+            training_data_params=args["data"],
+            training_structure_params=args["structure"],
+            n_classes=args["data"]["num_classes"],
+            optimizer_hparams=args["optimizer"],
+            evaluation_params=args["evaluation"],
+            ignore_index=args["data"]["label_mask"],
+            model_params=args["model"],
+            learning_hparams=args["learning_algorithm"]
+            | {
+                "meta_learner": meta_learner,
+                "reset_classifier": meta_learner == "protomaml",
+            },
+            model_architecture=args["model_architecture"],
+        )
+
+        step_timer = StepTimer()
+
+        trainer = pl.Trainer(
+            accelerator="gpu" if torch.cuda.is_available() else "cpu",
+            devices=1,
+            max_steps=bench_args["train_steps"] + 1,
+            logger=False,
+            enable_checkpointing=False,
+            enable_progress_bar=False,
+            enable_model_summary=False,
+            num_sanity_val_steps=0,
+            limit_val_batches=0,
+            inference_mode=False,
+            callbacks=[step_timer],
+        )
+
+        loader = DataLoader(dataset, batch_size=1, collate_fn=dataset.collate_fn_train)
+
+        trainer.fit(model, train_dataloaders=loader)
+
+        # The first step includes one-off allocations, treat it as a warm-up
+        timer.add(f"{meta_learner}_step", step_timer.times[1:])
+
+
+def run_benchmarks(args):
+    """
+    Runs all benchmarks on a synthetic dataset, written to `benchmark.data_dir`
+    or a temporary directory. Takes the resolved config as a dict, and returns
+    the timings of each stage alongside the environment and graph sizes.
+
+    """
+    bench_args = args["benchmark"]
+
+    seed_everything(args["seed"])
+
+    timer = StageTimer()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Never touch the real datasets
+        data_dir = bench_args["data_dir"] or tmp_dir
+        args["data"]["raw_data_dir"] = data_dir
+        args["data"]["processed_data_dir"] = data_dir
+
+        # ======================================================================
+        # Synthetic data
+        # ======================================================================
+        print_step("sampling synthetic social graph")
+        social_graph = sample_social_graph(
+            num_docs=bench_args["num_docs"],
+            num_users=bench_args["num_users"],
+            users_per_doc=bench_args["users_per_doc"],
+            follows_per_user=bench_args["follows_per_user"],
+            popularity_shape=bench_args["popularity_shape"],
+            prop_positive=bench_args["prop_positive"],
+            seed=args["seed"],
+        )
+
+        num_docs, num_users = write_synthetic_dataset(
+            args["data"],
+            social_graph,
+            feature_dim=bench_args["feature_dim"],
+            cur_fold=args["fold"],
+            version=args["version"],
+            seed=args["seed"],
+        )
+
+        # ======================================================================
+        # Benchmarks
+        # ======================================================================
+        dataset = benchmark_structuring(args, timer)
+
+        benchmark_sampling(args, timer, dataset)
+
+        benchmark_model(args, timer, dataset)
+
+        # Cached artifacts point into the removed data directory
+        ARTIFACT_CACHE.clear()
+
+    return {
+        "commit": get_git_commit(),
+        "timestamp": datetime.now().strftime("%Y%m%d-%H%M%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "device": torch.cuda.get_device_name()
+            if torch.cuda.is_available()
+            else "cpu",
+            "num_threads": torch.get_num_threads(),
+        },
+        "graph": {
+            "num_docs": num_docs,
+            "num_users": num_users,
+            "num_edges": timer.results["generate_adjacency_matrix"]["items"],
+        },
+        "benchmark": bench_args,
+        "stages": timer.results,
+    }
+
+
+def save_results(results, output_dir):
+    output_dir = create_dir(Path(output_dir))
+
+    commit = (results["commit"] or "nogit")[:8]
+    output_file = output_dir / f"benchmark_{commit}_{results['timestamp']}.json"
+
+    save_json_file(results, output_file, converter=np_converter)
+
+    return output_file
+
+
+@hydra.main(version_base=None, config_path="../config", config_name="benchmark")
+def benchmark(args: DictConfig):
+    print("*" * 100)
+    if args["print_config"]:
+        print(OmegaConf.to_yaml(args, resolve=True))
+    else:
+        "Config loaded but not printing."
+    print("*" * 100)
+
+    args = OmegaConf.to_container(args, resolve=True)
+
+    results = run_benchmarks(args)
+
+    print_step("saving results")
+    output_file = save_results(results, args["benchmark"]["output_dir"])
+
+    print(f"Results written to: {output_file}")
+
+
+if __name__ == "__main__":
+    benchmark()
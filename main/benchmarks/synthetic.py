@@ -0,0 +1,153 @@
+import numpy as np
+from datasets import Dataset, DatasetDict
+
+from data_prep.graph_io import GraphIO
+from data_prep.post_processing import PostProcessing
+
+
+def sample_social_graph(
+    num_docs: int,
+    num_users: int,
+    users_per_doc: float,
+    follows_per_user: float,
+    popularity_shape: float = 1.5,
+    prop_positive: float = 0.25,
+    split_props=(0.6, 0.2, 0.2),
+    seed: int = 942,
+):
+    """
+    Samples a synthetic social graph, with the same components as the real
+    datasets. Users engage with documents, and follow other users, in
+    proportion to a heavy-tailed (Pareto) popularity.
+
+    Returns a dict with:
+        - `doc2users` and `user2docs`: the doc-user engagements
+        - `user2users`: the user-user follows
+        - `doc2labels`: binary labels, with `prop_positive` positives
+        - `doc2split`: the `train`, `val` or `test` split of each doc
+
+    """
+    rng = np.random.default_rng(seed)
+
+    doc_ids = [f"doc_{i}" for i in range(num_docs)]
+    user_ids = [f"user_{i}" for i in range(num_users)]
+
+    # Few users are very active, most engage only a handful of times
+    popularity = rng.pareto(popularity_shape, size=num_users) + 1
+    popularity = popularity / popularity.sum()
+
+    # Doc-user engagements =====================================================
+    # Each document has at least a single engaging user
+    doc_degrees = 1 + rng.poisson(max(users_per_doc - 1, 0), size=num_docs)
+    engaged_users = rng.choice(num_users, size=doc_degrees.sum(), p=popularity)
+
+    doc2users = dict()
+    user2docs = dict()
+    for doc_id, users in zip(
+        doc_ids, np.split(engaged_users, np.cumsum(doc_degrees)[:-1])
+    ):
+        doc2users[doc_id] = {user_ids[user] for user in users}
+
+        for user_id in doc2users[doc_id]:
+            user2docs.setdefault(user_id, set()).add(doc_id)
+
+    # User-user follows ========================================================
+    # Popular users are both more likely to follow and to be followed
+    num_follows = int(follows_per_user * num_users)
+    followers = rng.choice(num_users, size=num_follows, p=popularity)
+    followees = rng.choice(num_users, size=num_follows, p=popularity)
+
+    user2users = dict()
+    for follower, followee in zip(followers, followees):
+        if follower != followee:
+            user2users.setdefault(user_ids[follower], set()).add(user_ids[followee])
+
+    # Labels and splits ========================================================
+    labels = (rng.random(num_docs) < prop_positive).astype(int)
+    doc2labels = dict(zip(doc_ids, labels.tolist()))
+
+    splits = rng.choice(["train", "val", "test"], size=num_docs, p=split_props)
+    doc2split = dict(zip(doc_ids, splits.tolist()))
+
+    return {
+        "doc2users": doc2users,
+        "user2docs": user2docs,
+        "user2users": user2users,
+        "doc2labels": doc2labels,
+        "doc2split": doc2split,
+    }
+
+
+def write_synthetic_dataset(
+    args, social_graph, feature_dim: int, cur_fold: int, version=None, seed=942
+):
+    """
+    Writes a sampled social graph to the data directory in `args`, in the
+    format left behind by content processing, graph processing and feature
+    extraction. Structuring can then run on it as if it were a real dataset.
+
+    Documents are embedded as noisy class means, users in order of popularity.
+
+    """
+    rng = np.random.default_rng(seed)
+
+    graph_io = GraphIO(args, version=version, enforce_raw=False)
+
+    doc_ids = sorted(social_graph["doc2users"], key=lambda x: int(x.split("_")[1]))
+    doc2nodeid = {doc_id: node_id for node_id, doc_id in enumerate(doc_ids)}
+
+    # Users are numbered after documents, the most active users first
+    user_ids = set(social_graph["user2docs"]) | set(social_graph["user2users"])
+    user_ids = user_ids.union(*social_graph["user2users"].values())
+    user_ids = sorted(
+        user_ids,
+        key=lambda user_id: (
+            -len(social_graph["user2docs"].get(user_id, ())),
+            int(user_id.split("_")[1]),
+        ),
+    )
+    user2nodeid = {
+        user_id: node_id for node_id, user_id in enumerate(user_ids, len(doc_ids))
+    }
+
+    graph_io.save_file("doc2users", social_graph["doc2users"])
+    graph_io.save_file("user2docs", social_graph["user2docs"])
+    graph_io.save_file("user2users", social_graph["user2users"])
+    graph_io.save_file("doc2labels", social_graph["doc2labels"])
+    graph_io.save_file("doc2nodeid", doc2nodeid)
+    graph_io.save_file("user2nodeid", user2nodeid)
+    graph_io.save_file("invalid_docs", set())
+    graph_io.save_file("invalid_users", set())
+
+    # Compressed document features =============================================
+    class_means = rng.normal(size=(args["num_classes"], feature_dim))
+
+    split_datasets = dict()
+    for split in ["train", "val", "test"]:
+        split_doc_ids = [
+            doc_id for doc_id in doc_ids if social_graph["doc2split"][doc_id] == split
+        ]
+        split_labels = [social_graph["doc2labels"][doc_id] for doc_id in split_doc_ids]
+
+        split_features = class_means[split_labels] + rng.normal(
+            scale=2.0, size=(len(split_doc_ids), feature_dim)
+        )
+
+        split_datasets[split] = Dataset.from_dict(
+            {
+                "node_id": [doc2nodeid[doc_id] for doc_id in split_doc_ids],
+                "x": split_features.astype(np.float32).tolist(),
+                "y": split_labels,
+            },
+            split=split,
+        )
+
+    post_processor = PostProcessing(
+        args,
+        cur_fold=cur_fold,
+        version=version,
+        processed_or_structured="processed",
+    )
+    post_processor.save_file("compressed_dataset", DatasetDict(split_datasets))
+
+    return len(doc2nodeid), len(user2nodeid)
@@ -0,0 +1,103 @@
+import time
+import statistics
+
+import torch
+import pytorch_lightning as pl
+
+
+def synchronize():
+    # CUDA kernels run asynchronously, wait for them before reading the clock
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def summarize_times(times, items: int = None):
+    summary = {
+        "repeats": len(times),
+        "times": times,
+        "mean": statistics.mean(times),
+        "median": statistics.median(times),
+        "min": min(times),
+        "max": max(times),
+    }
+
+    # Throughput of the typical repeat, e.g. edges or episodes per second
+    if items is not None:
+        summary["items"] = items
+        summary["items_per_second"] = items / summary["median"]
+
+    return summary
+
+
+class StageTimer:
+    """
+    Times benchmark stages, and collects a summary of each stage's wall-clock
+    times in `results`. An optional `setup` is run, untimed, before every
+    repeat, and its output is passed to the timed function. The number of
+    `items` processed can also be computed from the function's last output.
+
+    """
+
+    def __init__(self, logger=print):
+        self.logger = logger
+
+        self.results = dict()
+
+    def time(
+        self,
+        name: str,
+        fn,
+        repeats: int = 1,
+        warmup: int = 0,
+        setup=None,
+        items=None,
+    ):
+        times = []
+        for i in range(warmup + repeats):
+            if setup is not None:
+                inputs = setup()
+
+            synchronize()
+            start = time.perf_counter()
+
+            output = fn(inputs) if setup is not None else fn()
+
+            synchronize()
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+
+        if callable(items):
+            items = items(output)
+
+        self.add(name, times, items=items)
+
+        return output
+
+    def add(self, name: str, times, items: int = None):
+        self.results[name] = summarize_times(times, items=items)
+
+        summary_line = f"{name:<32} median {self.results[name]['median']:9.4f}s"
+        if items is not None:
+            summary_line += f" ({self.results[name]['items_per_second']:.2f} items/s)"
+
+        self.logger(summary_line)
+
+
+class StepTimer(pl.Callback):
+    """
+    Records the wall-clock time of each training step, excluding data loading.
+
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.times = []
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        synchronize()
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        synchronize()
+        self.times.append(time.perf_counter() - self._start)
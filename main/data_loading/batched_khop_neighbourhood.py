@@ -5,6 +5,7 @@ import torch_geometric
 from torch_geometric.utils import degree, to_torch_coo_tensor
 
 from data_prep.post_processing import SocialGraph
+from utils.graph_functions import count_two_hop_reach
 
 
 class BatchedKHopNeighbourhoodBase(SocialGraph, Dataset):
@@ -71,52 +72,18 @@ class BatchedKHopNeighbourhoodBase(SocialGraph, Dataset):
             labelled_nodes = torch.where(self.graph.mask)[0]
 
             num_nodes = self.graph.num_nodes
-            num_labelled_nodes = labelled_nodes.shape[0]
             num_docs = len(self.valid_docs)
 
-            # Use a message passing scheme
-            # First get the adjacency
-            sparse_adj = to_torch_coo_tensor(
-                self.graph.edge_index,
-                size=(num_nodes, num_nodes),
-            )
-
-            # Create the initial messages
-            # A 1 on each labelled document node
-            # Column is message initial location
-            # Row is message propagated to a neighbour
-            messages = torch.sparse_coo_tensor(
-                torch.stack([labelled_nodes, labelled_nodes]),
-                torch.ones((num_labelled_nodes,)),
-                (num_nodes, num_nodes),
-            )
-
-            # Left multiplied with the adjecency matrix
-            # The message gets passed to all its neighbours
-            messages = torch.matmul(sparse_adj, messages)
-
-            # Left multiplied with the adjecency matrix
-            # The message gets passed to all its neighbours' neighbours
-            messages = torch.matmul(sparse_adj, messages)
+            # The number of users that reside in each labelled node's 2-hop
+            # neighbourhood, counted directly on the sparse adjacency
+            user_mask = torch.arange(num_nodes) > num_docs
 
-            # Now get the users which received the message from the original labelled node
-            # Check which nodes are users
-            user_mask = messages.indices()[0] > num_docs
-
-            senders = messages.indices()[1, user_mask]
-
-            # Force every value to be a 1
-            user_received_messages = messages.values()[user_mask].bool().float()
-
-            # Add the user received messages (as booleans) to the original senders
-            # And presto! The node weights of the labelled nodes are the number of users
-            # that reside in its 2-hop neighbourhood
             self.node_weights = torch.zeros((num_nodes,))
-
-            self.node_weights.index_add_(
-                dim=0,
-                index=senders,
-                source=user_received_messages,
+            self.node_weights[labelled_nodes] = count_two_hop_reach(
+                self.graph.edge_index,
+                num_nodes=num_nodes,
+                source_nodes=labelled_nodes,
+                target_mask=user_mask,
             )
 
             # self.node_weights = (self.node_weights.max() + 1) - self.node_weights
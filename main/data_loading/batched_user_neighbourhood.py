@@ -2,16 +2,14 @@ import os
 import random
 import time
 import typing
-from collections import defaultdict, Counter
+from collections import defaultdict
 from copy import deepcopy
 from itertools import starmap
 import multiprocessing as mp
 from functools import partial
 
 import numpy as np
-import pymetis
 import torch
-from torch.nn.utils.rnn import pad_sequence
 import torch_geometric
 from torch_geometric.data import Data
 from torch_geometric.typing import SparseTensor
@@ -19,10 +17,77 @@ from torch_geometric.utils import k_hop_subgraph
 from torch_geometric.utils.convert import to_scipy_sparse_matrix
 
 from data_loading.batched_khop_neighbourhood import BatchedKHopNeighbourhoodBase
+from data_loading.partitioners import PARTITIONERS, get_partitioner
 from utils.logging import calc_elapsed_time
 from utils.rng import stochastic_method
 
 
+def assign_to_batches(node_ids, partition_ids, batch_size: int, logger=print):
+    """
+    Assigns samples to batches, such that each batch ideally holds one sample
+    from each partition. A sample's rank within its partition is its batch id.
+    Batches smaller than `batch_size` are then filled up with samples from the
+    last batches, until all but the final batch are full.
+
+    Returns the batch membership in CSR format, `(batch_offsets, batch_members)`.
+    Batch `i` consists of `batch_members[batch_offsets[i] : batch_offsets[i + 1]]`.
+
+    """
+    num_samples = node_ids.shape[0]
+    if num_samples == 0:
+        return np.zeros((1,), dtype=np.int64), node_ids
+
+    # Rank of each sample within its partition, keeping the original order
+    order = np.argsort(partition_ids, kind="stable")
+    node_ids, partition_ids = node_ids[order], partition_ids[order]
+
+    partition_starts = np.flatnonzero(
+        np.r_[True, partition_ids[1:] != partition_ids[:-1]]
+    )
+    partition_sizes = np.diff(np.r_[partition_starts, num_samples])
+    rank = np.arange(num_samples) - np.repeat(partition_starts, partition_sizes)
+
+    # The initial batches, one sample per partition in order of partition
+    order = np.lexsort((partition_ids, rank))
+    node_ids, rank = node_ids[order], rank[order]
+
+    rank_sizes = np.bincount(rank)
+    if np.any(rank_sizes > batch_size):
+        raise ValueError("Batch found larger than batch size...")
+
+    logger(f"\nFound {num_samples} samples over {rank_sizes.shape[0]} batches.")
+    logger(f"Found {np.sum(rank_sizes < batch_size)} batches smaller than batchsize")
+    logger("Folding smaller batches into larger ones.")
+
+    # All but the last batch end up full
+    num_batches = -(-num_samples // batch_size)
+
+    # Batches after the first `num_batches - 1` donate samples, starting with the
+    # front of the last batch. The first batches' deficits are filled in order,
+    # whatever remains goes into the final batch
+    is_donor = rank >= num_batches - 1
+
+    donor_order = np.lexsort((np.arange(num_samples)[is_donor], -rank[is_donor]))
+    donor_pos = np.empty_like(donor_order)
+    donor_pos[donor_order] = np.arange(donor_order.shape[0])
+
+    deficits = batch_size - rank_sizes[: num_batches - 1]
+    batch_ids = rank.copy()
+    batch_ids[is_donor] = np.searchsorted(np.cumsum(deficits), donor_pos, side="right")
+
+    # Within a batch, its own samples come first, then donated samples in order
+    stream_pos = np.zeros(num_samples, dtype=np.int64)
+    stream_pos[is_donor] = donor_pos
+    order = np.lexsort(
+        (np.arange(num_samples), stream_pos, batch_ids != rank, batch_ids)
+    )
+
+    batch_offsets = np.zeros((num_batches + 1,), dtype=np.int64)
+    batch_offsets[1:] = np.cumsum(np.bincount(batch_ids, minlength=num_batches))
+
+    return batch_offsets, node_ids[order]
+
+
 class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
     def __init__(
         self,
@@ -39,6 +104,7 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
         walk_length: int = 3,
         node_weights_dist: str = "inv_node_degree",
         label_dist: typing.Optional[str] = None,
+        partitioner: str = "metis",
         prefix: typing.Optional[str] = None,
         **superkwargs,
     ):
@@ -62,6 +128,11 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
         self.max_nodes_per_subgraph = max_nodes_per_subgraph
         self.walk_length = walk_length
 
+        if partitioner in PARTITIONERS:
+            self.partitioner = partitioner
+        else:
+            raise ValueError(f"Partitioner `{partitioner}` not recognized.")
+
         # Compression stats
         self.central_nodes = []
         self.needed_k_hops = []
@@ -76,7 +147,7 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
 
         self.prefix = prefix
 
-        self.node_occurences = Counter()
+        self.node_occurences = None
 
         if label_dist is None or label_dist == "node":
             self.label_dist = None
@@ -91,30 +162,50 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
         else:
             return _repr + ")"
 
+    def _partition_graph(self, partitioner):
+        # The CSR arrays are exactly METIS' `xadj` and `adjncy`
+        adj = to_scipy_sparse_matrix(
+            self.graph.edge_index, num_nodes=self.graph.num_nodes
+        ).tocsr()
+
+        self.log(f"Using {type(partitioner).__name__} to partition graph")
+        n_cuts, membership = partitioner(adj.indptr, adj.indices)
+
+        return {"n_cuts": n_cuts, "membership": torch.from_numpy(membership)}
+
     @stochastic_method
     def partition_into_batches(self):
         start_time = time.time()
         self.print_step("Partitioning graph into batches")
 
-        # Generate the edge_list from the edge_index
-        edge_list = to_scipy_sparse_matrix(
-            self.graph.edge_index, num_nodes=self.graph.num_nodes
-        )
-        edge_list = edge_list.tolil(copy=True)
-        edge_list = edge_list.rows
-
-        # Use METIS to partition into buckets
+        # Partition into buckets
         # A batch consists of samples from all buckets
         # Maximizes the coverage per batch
-        self.log("Using METIS to partition graph")
-        n_cuts, membership = pymetis.part_graph(
+        partitioner = get_partitioner(
+            self.partitioner,
+            num_parts=self.batch_size,
+            seed=self.seed,
+            logger=self.log,
+        )
+
+        # Partitions only depend on the graph, so are cached across builds
+        cache_key = self.content_hash(
+            self.graph.edge_index,
+            self.graph.num_nodes,
             self.batch_size,
-            adjacency=edge_list,
-            options=pymetis.Options(
-                seed=self.seed,
-            ),
+            self.seed,
+            type(partitioner).__name__,
+        )
+
+        partition = self.cached(
+            "partition",
+            cache_key,
+            compute_fn=lambda: self._partition_graph(partitioner),
         )
 
+        n_cuts = partition["n_cuts"]
+        membership = partition["membership"].tolist()
+
         self.log(f"Cut size: {n_cuts}, {n_cuts/self.graph.num_edges*100:.2f}%")
 
         # Distribute the samples in buckets to batches
@@ -331,6 +422,84 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
 
         return (central_id, partition_id, subgraph_info)
 
+    def _aggregate_subgraphs(self, batch_n, batch):
+        """
+        Aggregates the subgraphs in `batch` into a single disjoint graph.
+        All subgraph sizes are read first, such that the outputs can be
+        preallocated and filled in place at their node and edge offsets.
+
+        """
+        subgraphs = [
+            torch.load(
+                self.neighbourhood_dir / f"subgraph_{central_id}.pt",
+                weights_only=True,
+            )
+            for central_id in batch
+        ]
+
+        num_nodes = torch.tensor([subgraph["num_nodes"] for subgraph in subgraphs])
+        num_edges = torch.tensor([subgraph["num_edges"] for subgraph in subgraphs])
+
+        # Offsets of each subgraph in the batched graph
+        node_ptr = torch.cumsum(num_nodes, dim=0) - num_nodes
+        edge_ptr = torch.cumsum(num_edges, dim=0) - num_edges
+
+        graph_idx = torch.empty(
+            (num_nodes.sum(),), dtype=subgraphs[0]["graph_idx"].dtype
+        )
+        edge_index = torch.empty(
+            (2, num_edges.sum()), dtype=subgraphs[0]["edge_index"].dtype
+        )
+
+        for subgraph, node_start, edge_start in zip(subgraphs, node_ptr, edge_ptr):
+            graph_idx[node_start : node_start + subgraph["num_nodes"]] = subgraph[
+                "graph_idx"
+            ]
+
+            edge_slice = edge_index[:, edge_start : edge_start + subgraph["num_edges"]]
+            edge_slice.copy_(subgraph["edge_index"])
+            edge_slice.add_(node_start)
+
+        batched_subgraphs = {
+            "batch_n": torch.tensor(batch_n),
+            "partition_id": [subgraph["partition_id"] for subgraph in subgraphs],
+            "batch_ptr": node_ptr,
+            "central_nodes": torch.cat(
+                [subgraph["central_nodes"] for subgraph in subgraphs], dim=-1
+            ),
+            "graph_idx": graph_idx,
+            "edge_index": edge_index,
+            "num_nodes": num_nodes.sum(),
+            "num_edges": num_edges.sum(),
+        }
+
+        # Label locations and probabilities, padded to the most labels present
+        for l in self.labels:
+            label_info = [subgraph["label_info"][l] for subgraph in subgraphs]
+
+            max_num_labels = max(locs.reshape(-1).shape[0] for locs, _ in label_info)
+
+            label_locs = torch.full(
+                (len(subgraphs), max_num_labels),
+                fill_value=-1,
+                dtype=label_info[0][0].dtype,
+            )
+            label_probs = torch.zeros(
+                (len(subgraphs), max_num_labels), dtype=label_info[0][1].dtype
+            )
+
+            for i, ((locs, probs), node_start) in enumerate(zip(label_info, node_ptr)):
+                locs, probs = locs.reshape(-1), probs.reshape(-1)
+
+                # Also update the label locations with the batch ptr
+                label_locs[i, : locs.shape[0]] = locs + node_start
+                label_probs[i, : probs.shape[0]] = probs
+
+            batched_subgraphs[f"label_{l}_locs"] = label_locs
+            batched_subgraphs[f"label_{l}_probs"] = label_probs
+
+        return batched_subgraphs
+
     @stochastic_method
     def generate_batches(self, num_workers: int = 0):
         start_time = time.time()
@@ -381,13 +550,14 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
         self.log(f"Time taken: {hours:02d}:{minutes:02d}:{seconds:02d}")
 
         # Filter out all the unsuccesfull subgraphs
-        clusters_succes = defaultdict(list)
+        succes_node_ids, succes_partition_ids = [], []
 
         for result in subgraphs:
             if result is not None:
                 node_id, partition_id, subgraph_info = result
 
-                clusters_succes[partition_id].append(node_id)
+                succes_node_ids.append(node_id)
+                succes_partition_ids.append(partition_id)
 
                 self.pre_num_nodes.append(subgraph_info["pre_num_nodes"])
                 self.post_num_nodes.append(subgraph_info["post_num_nodes"])
@@ -436,66 +606,21 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
             self.log(f"{hops} | {count:>5} {count / Z * 100:.2f}%")
 
         self.log(f"\n+=== Assigning subgraphs to batches ===+")
-        # Rebuild the clusters lists
-        # Keeping only those subgraphs that were succesful
-
-        # Resort the clusters
-        clusters_succes = list(
-            map(lambda x: x[1], sorted(clusters_succes.items(), key=lambda x: x[0]))
-        )
-
-        # Fuse the batches together
         # Ideally, each batch gets one sample from each partition
-        batches = defaultdict(list)
-        for node_ids in clusters_succes:
-            for batch_id, node_id in enumerate(node_ids):
-                batches[batch_id].append(node_id)
-
-        batches = list(map(lambda x: x[1], sorted(batches.items(), key=lambda x: x[0])))
-
-        self.log(
-            f"\nFound {sum(map(len, batches))} samples over {len(batches)} batches."
+        # Smaller batches at the end get folded into the others
+        batch_offsets, batch_members = assign_to_batches(
+            np.array(succes_node_ids, dtype=np.int64),
+            np.array(succes_partition_ids, dtype=np.int64),
+            batch_size=self.batch_size,
+            logger=self.log,
         )
-        self.log(
-            f"Found {sum(map(lambda x: len(x) < self.batch_size, batches))} batches smaller than batchsize"
-        )
-        self.log("Folding smaller batches into larger ones.")
-
-        # Batches at the end are going to be smaller than batch size
-        # Just take those and put them into another batch that needs more samples
-        ptr_l = 0
-        # Iterate over the batches from left to right
-        while ptr_l < len(batches) - 1:
-            batch_l = batches[ptr_l]
-
-            # If the batch is large enough go to next batch
-            if len(batch_l) == self.batch_size:
-                ptr_l += 1
-                continue
-
-            # If batch needs more samples, take some from a smaller batch
-            elif len(batch_l) < self.batch_size:
-                # Figure out how much of the right batch can be put in the left batch
-                n_needed = self.batch_size - len(batch_l)
-                n_available = len(batches[-1])
-                n_given = min(n_needed, n_available)
-
-                # Move that amount
-                batches[ptr_l] = batch_l + batches[-1][:n_given]
-                batches[-1] = batches[-1][n_given:]
-
-                # Get rid of the right batch if empty
-                if len(batches[-1]) == 0:
-                    del batches[-1]
-
-            else:
-                raise ValueError("Batch found larger than batch size...")
+        num_batches = batch_offsets.shape[0] - 1
 
         self.log(
-            f"\nFound {sum(map(len, batches))} samples over {len(batches)} batches."
+            f"\nFound {batch_members.shape[0]} samples over {num_batches} batches."
         )
         self.log(
-            f"Found {sum(map(lambda x: len(x) < self.batch_size, batches))} batches smaller than batchsize"
+            f"Found {np.sum(np.diff(batch_offsets) < self.batch_size)} batches smaller than batchsize"
         )
 
         self.log("\n+=== Aggregating subgraphs into batches ===+")
@@ -504,78 +629,18 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
         self.batches = list()
         self.batch_information = defaultdict(list)
 
-        for batch_n, batch in enumerate(batches):
-            batched_subgraphs = {
-                "batch_n": batch_n,
-                "partition_id": [],
-                "batch_ptr": [],
-                "central_nodes": [],
-                "graph_idx": [],
-                "edge_index": [],
-                "num_nodes": 0,
-                "num_edges": 0,
-            }
-            for l in self.labels:
-                batched_subgraphs.update(
-                    {f"label_{l}_locs": [], f"label_{l}_probs": []}
-                )
-
-            batch_ptr = torch.tensor(0)
-
-            for central_id in batch:
-                subgraph = torch.load(
-                    self.neighbourhood_dir / f"subgraph_{central_id}.pt",
-                    weights_only=True,
-                )
-
-                cur_batch_ptr = batch_ptr.detach().clone()
-
-                self.node_occurences.update(subgraph["graph_idx"].tolist())
-
-                # Populate the batch with subgraph information
-                batched_subgraphs["partition_id"] += [subgraph["partition_id"]]
-                batched_subgraphs["batch_ptr"] += [cur_batch_ptr]
-                batched_subgraphs["central_nodes"] += [subgraph["central_nodes"]]
-                batched_subgraphs["graph_idx"] += [subgraph["graph_idx"]]
-                batched_subgraphs["edge_index"] += [
-                    subgraph["edge_index"] + cur_batch_ptr
-                ]
-                batched_subgraphs["num_nodes"] += subgraph["num_nodes"]
-                batched_subgraphs["num_edges"] += subgraph["num_edges"]
+        self.node_occurences = torch.zeros((self.graph.num_nodes,), dtype=torch.long)
 
-                for l in self.labels:
-                    locs, probs = subgraph["label_info"][l]
+        for batch_n in range(num_batches):
+            batch = batch_members[
+                batch_offsets[batch_n] : batch_offsets[batch_n + 1]
+            ].tolist()
 
-                    # Also update the label locations with the batch ptr
-                    locs = locs + cur_batch_ptr
+            batched_subgraphs = self._aggregate_subgraphs(batch_n, batch)
 
-                    batched_subgraphs[f"label_{l}_locs"].append(locs)
-                    batched_subgraphs[f"label_{l}_probs"].append(probs)
-
-                batch_ptr += subgraph["num_nodes"]
-
-            # Aggregate the subgraphs together into a single disjoint graph
-            for k, v in batched_subgraphs.items():
-                if "label" not in k:
-                    if isinstance(v, list) and isinstance(v[0], torch.Tensor):
-                        if len(v[0].shape) > 0:
-                            batched_subgraphs[k] = torch.cat(v, dim=-1)
-                        else:
-                            batched_subgraphs[k] = torch.stack(v, dim=0)
-
-                    elif (
-                        isinstance(v, int)
-                        or isinstance(v, float)
-                        or isinstance(v, bool)
-                    ):
-                        batched_subgraphs[k] = torch.tensor(v)
-
-                else:
-                    batched_subgraphs[k] = pad_sequence(
-                        v,
-                        batch_first=True,
-                        padding_value=-1 if "locs" in k else 0.0,
-                    )
+            self.node_occurences += torch.bincount(
+                batched_subgraphs["graph_idx"], minlength=self.graph.num_nodes
+            )
 
             # Save the batched subgraph
             torch.save(
@@ -601,8 +666,8 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
 
             if (
                 batch_n == 0
-                or batch_n % max(1, len(batches) // 10) == 0
-                or batch_n == len(batches) - 1
+                or batch_n % max(1, num_batches // 10) == 0
+                or batch_n == num_batches - 1
             ):
                 self.log(
                     f"{batch_n:04} | Batch size: {self.batch_information['batch_size'][-1]} Num. nodes: {self.batch_information['num_nodes'][-1] / 1e+3:.2f}K Num. edges: {self.batch_information['num_edges'][-1] / 1e+6:.2f}M"
@@ -614,14 +679,7 @@ class BatchedKHopUserNeighbourhood(BatchedKHopNeighbourhoodBase):
             self._label_dist = self.node_weights
 
         elif self.label_dist == "frequency":
-            self._label_dist = torch.zeros((self.graph.num_nodes,))
-
-            idx, counts = list(map(list, zip(*self.node_occurences.items())))
-
-            counts = torch.tensor(counts, dtype=torch.float)
-
-            self._label_dist[idx] = counts
-            self._label_dist = 1 / self._label_dist
+            self._label_dist = 1 / self.node_occurences.float()
 
         end = time.time()
         hours, minutes, seconds = calc_elapsed_time(start, end)
@@ -8,6 +8,7 @@ from torch.utils.data import IterableDataset
 
 from data_prep.post_processing import SocialGraph
 from data_loading.batched_doc_neighbourhood import BatchedKHopDocumentNeighbourhood
+from data_loading.prefetch import shared_generator, worker_shard
 from utils.logging import calc_elapsed_time
 from utils.rng import stochastic_method
 
@@ -486,15 +487,20 @@ class EpisodicKHopDocsOnlySocialGraph(SocialGraph, IterableDataset):
     @stochastic_method
     def __iter__(self):
         if self.split == "train":
+            # All workers draw the same order, but each only yields its shard
+            generator = shared_generator()
+
             n_support_batches = len(self.support_graph_dataset)
 
-            support_idx = torch.randperm(n_support_batches).tolist()
+            support_idx = torch.randperm(
+                n_support_batches, generator=generator
+            ).tolist()
 
             n_query_batches = len(self.query_graph_dataset)
 
-            query_idx = torch.randperm(n_query_batches).tolist()
+            query_idx = torch.randperm(n_query_batches, generator=generator).tolist()
 
-            for i in range(self.max_episodes):
+            for i in worker_shard(range(self.max_episodes)):
                 support_graph = self.support_graph_dataset[support_idx[i]]
 
                 query_graph = self.query_graph_dataset[query_idx[i]]
@@ -505,11 +511,15 @@ class EpisodicKHopDocsOnlySocialGraph(SocialGraph, IterableDataset):
             # If the current split is not train, the query set is just the entire graph
             # No need to perform subgraph sampling
 
+            generator = shared_generator()
+
             n_support_batches = len(self.support_graph_dataset)
 
-            support_idx = torch.randperm(n_support_batches).tolist()
+            support_idx = torch.randperm(
+                n_support_batches, generator=generator
+            ).tolist()
 
-            for i in range(n_support_batches):
+            for i in worker_shard(range(n_support_batches)):
                 support_graph = self.support_graph_dataset[support_idx[i]]
 
                 query_graph = None
@@ -8,6 +8,7 @@ from torch.utils.data import IterableDataset
 from data_prep.post_processing import SocialGraph
 from data_loading.batched_doc_neighbourhood import BatchedKHopDocumentNeighbourhood
 from data_loading.batched_user_neighbourhood import BatchedKHopUserNeighbourhood
+from data_loading.prefetch import shared_generator, worker_shard
 from utils.logging import calc_elapsed_time
 from utils.rng import stochastic_method
 from utils.graph_functions import random_walk_subsampling_from_centernode
@@ -31,6 +32,7 @@ class EpisodicKHopNeighbourhoodSocialGraph(SocialGraph, IterableDataset):
         node_weights_dist: str,
         label_dist: str,
         max_samples_per_partition: int,
+        partitioner: str = "metis",
         _doc_limit: int = -1,
         prefix: typing.Optional[str] = None,
         **super_kwargs,
@@ -59,6 +61,7 @@ class EpisodicKHopNeighbourhoodSocialGraph(SocialGraph, IterableDataset):
         self.max_nodes_per_subgraph = max_nodes_per_subgraph
         self.walk_length = walk_length
         self.label_dist = label_dist
+        self.partitioner = partitioner
 
         # Args and kwargs for `EvalBatchedKHopNeighbourhoodSocialGraph`
         # Used for sampling support set
@@ -386,6 +389,7 @@ class EpisodicKHopNeighbourhoodSocialGraph(SocialGraph, IterableDataset):
             walk_length=self.walk_length,
             node_weights_dist=self.node_weights_dist,
             label_dist=self.label_dist,
+            partitioner=self.partitioner,
             prefix="meta_train_support",
             version=self.version,
         )
@@ -436,15 +440,20 @@ class EpisodicKHopNeighbourhoodSocialGraph(SocialGraph, IterableDataset):
     @stochastic_method
     def __iter__(self):
         if self.split == "train":
+            # All workers draw the same order, but each only yields its shard
+            generator = shared_generator()
+
             n_support_batches = len(self.support_graph_dataset)
 
-            support_idx = torch.randperm(n_support_batches).tolist()
+            support_idx = torch.randperm(
+                n_support_batches, generator=generator
+            ).tolist()
 
             n_query_batches = len(self.query_graph_dataset)
 
-            query_idx = torch.randperm(n_query_batches).tolist()
+            query_idx = torch.randperm(n_query_batches, generator=generator).tolist()
 
-            for i in range(self.max_episodes):
+            for i in worker_shard(range(self.max_episodes)):
                 support_graph = self.support_graph_dataset[support_idx[i]]
 
                 query_graph = self.query_graph_dataset[query_idx[i]]
@@ -455,11 +464,15 @@ class EpisodicKHopNeighbourhoodSocialGraph(SocialGraph, IterableDataset):
             # If the current split is not train, the query set is just the entire graph
             # No need to perform subgraph sampling
 
+            generator = shared_generator()
+
             n_support_batches = len(self.support_graph_dataset)
 
-            support_idx = torch.randperm(n_support_batches).tolist()
+            support_idx = torch.randperm(
+                n_support_batches, generator=generator
+            ).tolist()
 
-            for i in range(n_support_batches):
+            for i in worker_shard(range(n_support_batches)):
                 support_graph = self.support_graph_dataset[support_idx[i]]
 
                 query_graph = None
@@ -1,3 +1,4 @@
+import torch
 from torch.utils.data import DataLoader
 import torch_geometric
 
@@ -10,6 +11,7 @@ from data_loading.episodic_batched_khop_neighbourdhood import (
 from data_loading.episodic_batched_doc_only_neighbourhood import (
     EpisodicKHopDocsOnlySocialGraph,
 )
+from data_loading.prefetch import PrefetchLoader, DeviceTransferLoader
 
 
 def get_dataset(args, split: str, load: bool = False):
@@ -59,6 +61,7 @@ def get_dataset(args, split: str, load: bool = False):
                 max_samples_per_partition=args["structure"][
                     "max_samples_per_partition"
                 ],
+                partitioner=args["structure"].get("partitioner", "metis"),
             )
 
         else:
@@ -104,6 +107,7 @@ def get_dataset(args, split: str, load: bool = False):
                 if split == "train"
                 else args["structure"]["max_samples_per_eval_partition"]
             ),
+            partitioner=args["structure"].get("partitioner", "metis"),
             # Episodic kwargs
             k=args["k"],
             shots=args["shots"],
@@ -153,6 +157,15 @@ def get_dataloader(args, split: str, **dataloader_kwargs):
 
     dataset = get_dataset(args, split, load=True)
 
+    # Not a DataLoader argument, number of episodes to collate ahead of time
+    dataloader_kwargs = dict(dataloader_kwargs)
+    prefetch_episodes = dataloader_kwargs.pop("prefetch_episodes", 0)
+    transfer_to_device = dataloader_kwargs.pop("transfer_to_device", False)
+
+    # Pinned memory only speeds up copies to a GPU
+    if not torch.cuda.is_available():
+        dataloader_kwargs["pin_memory"] = False
+
     if args["structure"]["structure"] == "full":
         loader = torch_geometric.loader.DataLoader(
             dataset, batch_size=1, **dataloader_kwargs
@@ -190,9 +203,17 @@ def get_dataloader(args, split: str, **dataloader_kwargs):
                 **dataloader_kwargs,
             )
 
+        # Worker processes already collate ahead, otherwise use a background thread
+        if prefetch_episodes > 0 and dataloader_kwargs.get("num_workers", 0) == 0:
+            loader = PrefetchLoader(loader, max_prefetch=prefetch_episodes)
+
     else:
         raise ValueError(
             "`structure.structure` must be one of [`full`, `khop`, `episodic_khop`, `episodic_doc_only_khop`]"
         )
 
+    # Copy the next batch to the GPU while the current one is in use
+    if transfer_to_device and torch.cuda.is_available():
+        loader = DeviceTransferLoader(loader)
+
     return loader
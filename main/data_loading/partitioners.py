@@ -0,0 +1,163 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+# METIS is only needed for the `metis` partitioner
+try:
+    import pymetis
+except ImportError:
+    pymetis = None
+
+
+class GraphPartitioner:
+    """
+    Splits a graph, given in CSR format as `xadj` and `adjncy` (as used by
+    METIS), into `num_parts` partitions of roughly equal size.
+
+    Returns the number of cut edges, and the partition of each node.
+
+    """
+
+    def __init__(self, num_parts: int, seed: int):
+        self.num_parts = num_parts
+        self.seed = seed
+
+    def __call__(self, xadj, adjncy):
+        raise NotImplementedError()
+
+    @staticmethod
+    def count_cuts(xadj, adjncy, membership):
+        rows = np.repeat(np.arange(xadj.shape[0] - 1), np.diff(xadj))
+
+        return int(np.sum(membership[rows] != membership[adjncy]) // 2)
+
+
+class MetisPartitioner(GraphPartitioner):
+    def __call__(self, xadj, adjncy):
+        n_cuts, membership = pymetis.part_graph(
+            self.num_parts,
+            xadj=xadj,
+            adjncy=adjncy,
+            options=pymetis.Options(
+                seed=self.seed,
+            ),
+        )
+
+        return n_cuts, np.asarray(membership)
+
+
+class LabelPropagationPartitioner(GraphPartitioner):
+    """
+    Size constrained label propagation. Starting from contiguous chunks of a
+    bandwidth reducing (reverse Cuthill-McKee) node ordering, nodes move to the
+    partition most common among their neighbours. Partitions never grow beyond
+    their capacity, arrivals that would overflow a partition are reverted.
+
+    Lower quality than METIS, but fast and without additional dependencies.
+
+    """
+
+    def __init__(
+        self,
+        num_parts: int,
+        seed: int,
+        num_iters: int = 16,
+        imbalance: float = 0.03,
+    ):
+        super().__init__(num_parts, seed)
+
+        self.num_iters = num_iters
+        self.imbalance = imbalance
+
+    @staticmethod
+    def _rank_within(groups, num_groups):
+        # Position of each element within its group, `groups` must be sorted
+        group_starts = np.searchsorted(groups, np.arange(num_groups))
+
+        return np.arange(groups.shape[0]) - group_starts[groups]
+
+    def __call__(self, xadj, adjncy):
+        num_nodes = xadj.shape[0] - 1
+        node_idx = np.arange(num_nodes)
+
+        adj = sp.csr_matrix(
+            (np.ones(adjncy.shape[0], dtype=np.float32), adjncy, xadj),
+            shape=(num_nodes, num_nodes),
+        )
+
+        rng = np.random.default_rng(self.seed)
+
+        # Neighbouring nodes tend to end up in the same initial partition
+        ordering = reverse_cuthill_mckee(adj, symmetric_mode=True)
+        membership = np.empty((num_nodes,), dtype=np.int64)
+        membership[ordering] = node_idx * self.num_parts // num_nodes
+
+        capacity = int(np.ceil(num_nodes / self.num_parts * (1 + self.imbalance)))
+
+        for _ in range(self.num_iters):
+            # Number of neighbours in each partition
+            counts = adj @ np.eye(self.num_parts, dtype=np.float32)[membership]
+
+            # Random tie-breaking, only move for a strict improvement
+            preferred = np.argmax(counts + rng.random(counts.shape) * 0.5, axis=1)
+            gain = counts[node_idx, preferred] - counts[node_idx, membership]
+
+            movers = np.flatnonzero((preferred != membership) & (gain > 0))
+            if movers.shape[0] == 0:
+                break
+
+            # Movers grouped per target, highest gain first
+            movers = movers[np.lexsort((rng.random(movers.shape[0]), -gain[movers]))]
+            movers = movers[np.argsort(preferred[movers], kind="stable")]
+
+            targets = preferred[movers]
+            sources = membership[movers]
+            priority = self._rank_within(targets, self.num_parts)
+
+            # Admit as many as leave the target, plus its remaining capacity
+            sizes = np.bincount(membership, minlength=self.num_parts)
+            leaving = np.bincount(sources, minlength=self.num_parts)
+            admitted = priority < (capacity - sizes + leaving)[targets]
+
+            movers, targets = movers[admitted], targets[admitted]
+            sources, priority = sources[admitted], priority[admitted]
+
+            membership[movers] = targets
+
+            # Not all leavers necessarily left, revert the lowest priority
+            # arrivals until no partition overflows
+            moved = np.ones(movers.shape[0], dtype=bool)
+            while True:
+                overflow = np.bincount(membership, minlength=self.num_parts) - capacity
+                if not np.any(overflow > 0):
+                    break
+
+                candidates = np.flatnonzero(moved & (overflow[targets] > 0))
+                candidates = candidates[
+                    np.lexsort((-priority[candidates], targets[candidates]))
+                ]
+
+                rank = self._rank_within(targets[candidates], self.num_parts)
+                reverted = candidates[rank < overflow[targets[candidates]]]
+
+                membership[movers[reverted]] = sources[reverted]
+                moved[reverted] = False
+
+        return self.count_cuts(xadj, adjncy, membership), membership
+
+
+PARTITIONERS = {
+    "metis": MetisPartitioner,
+    "label_propagation": LabelPropagationPartitioner,
+}
+
+
+def get_partitioner(partitioner: str, num_parts: int, seed: int, logger=print):
+    if partitioner not in PARTITIONERS:
+        raise ValueError(f"Partitioner `{partitioner}` not recognized.")
+
+    if partitioner == "metis" and pymetis is None:
+        logger("\n>>>WARNING: PYMETIS NOT FOUND, USING LABEL PROPAGATION<<<\n")
+        partitioner = "label_propagation"
+
+    return PARTITIONERS[partitioner](num_parts=num_parts, seed=seed)
@@ -0,0 +1,226 @@
+from copy import copy
+import queue
+import threading
+
+import torch
+from torch.utils.data import get_worker_info
+
+
+def shared_generator():
+    """
+    A generator seeded identically in all DataLoader workers of an epoch, such
+    that all workers draw the same random episode order. Returns `None` on the
+    main process, i.e. the global RNG is used.
+
+    """
+    worker_info = get_worker_info()
+
+    if worker_info is None:
+        return None
+
+    # Each worker's seed is the epoch's base seed plus its id
+    generator = torch.Generator()
+    generator.manual_seed(worker_info.seed - worker_info.id)
+
+    return generator
+
+
+def worker_shard(items):
+    """
+    The share of `items` for the current DataLoader worker, if any.
+
+    """
+    worker_info = get_worker_info()
+
+    if worker_info is None:
+        return items
+
+    return items[worker_info.id :: worker_info.num_workers]
+
+
+class _PrefetchEnd:
+    pass
+
+
+class BackgroundPrefetcher:
+    """
+    Iterates over `iterable` in a background thread, keeping at most
+    `max_prefetch` items ready in a queue. Exceptions raised while iterating
+    are re-raised in the consuming thread.
+
+    """
+
+    def __init__(self, iterable, max_prefetch: int = 2):
+        self.iterable = iterable
+        self.max_prefetch = max_prefetch
+
+    def _produce(self, items, stop_event):
+        try:
+            for item in self.iterable:
+                # Blocks while the queue is full, checking for early stopping
+                while not stop_event.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+
+                if stop_event.is_set():
+                    return
+
+            items.put(_PrefetchEnd)
+
+        except Exception as e:
+            items.put(e)
+
+    def __iter__(self):
+        items = queue.Queue(maxsize=self.max_prefetch)
+        stop_event = threading.Event()
+
+        producer = threading.Thread(
+            target=self._produce, args=(items, stop_event), daemon=True
+        )
+        producer.start()
+
+        try:
+            while True:
+                item = items.get()
+
+                if item is _PrefetchEnd:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+
+                yield item
+
+        finally:
+            # Also reached if the consumer stops early
+            stop_event.set()
+
+    def __len__(self):
+        return len(self.iterable)
+
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoader running on the main process, such that the next
+    `max_prefetch` collated episodes are prepared in a background thread while
+    the current one trains. Other attributes are those of the wrapped loader.
+
+    Sampling and collating then draw from the global torch RNG concurrently with
+    the training step, so runs are no longer reproducible under a fixed seed.
+    Worker processes (`num_workers > 0`) prefetch without this issue.
+
+    """
+
+    def __init__(self, loader, max_prefetch: int = 2):
+        self.loader = loader
+        self.max_prefetch = max_prefetch
+
+    def __iter__(self):
+        return iter(BackgroundPrefetcher(self.loader, self.max_prefetch))
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if name == "loader":
+            raise AttributeError(name)
+
+        return getattr(self.loader, name)
+
+
+def _apply_to_tensors(batch, fn):
+    """
+    Applies `fn` to all tensors in a (nested) batch of tensors, graphs and
+    containers thereof. Graphs are shallow copied first, so graphs held by the
+    dataset are never modified.
+
+    """
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+
+    elif hasattr(batch, "apply") and hasattr(batch, "stores"):
+        return copy(batch).apply(fn)
+
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(_apply_to_tensors(item, fn) for item in batch)
+
+    elif isinstance(batch, dict):
+        return {key: _apply_to_tensors(item, fn) for key, item in batch.items()}
+
+    return batch
+
+
+class DeviceTransferLoader:
+    """
+    Wraps a loader, copying each batch to a CUDA device asynchronously on a
+    side stream. The next batch is copied while the current one is in use.
+
+    Copies are only truly asynchronous from pinned memory, i.e. the wrapped
+    DataLoader should use `pin_memory=True`. For non-CUDA devices, iterates
+    over the wrapped loader directly, without any copies.
+
+    """
+
+    def __init__(self, loader, device=None):
+        self.loader = loader
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        self.device = torch.device(device)
+
+    def _transfer(self, batch, stream):
+        with torch.cuda.stream(stream):
+            batch = _apply_to_tensors(
+                batch, lambda t: t.to(self.device, non_blocking=True)
+            )
+
+            # Marks the end of this batch's copies only, not of later ones
+            copied = torch.cuda.Event()
+            copied.record(stream)
+
+        return batch, copied
+
+    def _wait(self, batch, copied):
+        # Memory allocated on the side stream is now used on the current stream
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(copied)
+
+        def record(t):
+            t.record_stream(current_stream)
+            return t
+
+        return _apply_to_tensors(batch, record)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            yield from self.loader
+            return
+
+        stream = torch.cuda.Stream(self.device)
+
+        # Double buffering, the next batch is in flight while yielding the current
+        next_batch = None
+        for batch in self.loader:
+            batch = self._transfer(batch, stream)
+
+            if next_batch is not None:
+                yield self._wait(*next_batch)
+
+            next_batch = batch
+
+        if next_batch is not None:
+            yield self._wait(*next_batch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if name == "loader":
+            raise AttributeError(name)
+
+        return getattr(self.loader, name)
@@ -22,3 +22,6 @@ ADJACENCY_MATRIX_FILE = "adj_matrix.npz"
 EDGE_TYPE_FILE = "edge_type.npz"
 
 SPLIT_ID_FILE = "split_idx.pickle"
+
+LM_EMBEDDINGS_FILE = "lm_embeddings.npy"
+FEATURE_EXTRACTOR_HPARAMS_FILE = "feature_extractor_hparams.json"
@@ -1,3 +1,4 @@
+import os
 import abc
 import time
 from collections import Counter, defaultdict
@@ -5,11 +6,16 @@ from collections import Counter, defaultdict
 import numpy as np
 import datasets
 from datasets import Dataset
+from datasets.fingerprint import Hasher
+import pyarrow.compute as pc
 
 from data_prep.graph_io import GraphIO
 from data_prep.tokenizers import OneHotTokenizer, LMTokenizer
 from utils.logging import calc_elapsed_time
-from utils.io import load_json_file
+from utils.io import load_json_file, create_dir
+
+# Number of tokenizations kept in a dataset's tokenization cache
+TOKENIZATION_CACHE_SIZE = 4
 
 
 class ContentProcessor(GraphIO):
@@ -22,6 +28,9 @@ class ContentProcessor(GraphIO):
         self.summary["Num isolated docs"] = 0
         self.summary["Num unlabelled docs"] = 0
 
+        # Number of processes used for tokenization and filtering
+        self.num_proc = args.get("num_proc", 1)
+
     @abc.abstractmethod
     def load_content(self, invalid_docs):
         raise NotImplementedError()
@@ -56,6 +65,123 @@ class ContentProcessor(GraphIO):
         hours, minutes, seconds = calc_elapsed_time(start_time, end_time)
         self.log(f"Time taken: {hours:02d}:{minutes:02d}:{seconds:02d}")
 
+    def tokenize_documents(self, doc_dataset, tokenizer, content_fingerprint=None):
+        """
+        Batched, multi-process tokenization of the `raw_text` column.
+        The output is stored in the `datasets` Arrow cache, keyed by the content
+        and tokenizer fingerprints. Re-runs with the same inputs skip tokenization.
+
+        """
+        if content_fingerprint is None:
+            content_fingerprint = doc_dataset._fingerprint
+
+        fingerprint = Hasher.hash((content_fingerprint, tokenizer.fingerprint))
+
+        # Lives outside of the dataset version's directories, survives resets
+        cache_dir = create_dir(self.data_tsv_dir / self.dataset / "tokenization_cache")
+
+        doc_dataset = doc_dataset.map(
+            lambda batch: tokenizer.tokenize_batch(batch["raw_text"]),
+            batched=True,
+            num_proc=self.num_proc,
+            cache_file_name=str(cache_dir / f"tokenized_{fingerprint}.arrow"),
+            load_from_cache_file=True,
+            new_fingerprint=fingerprint,
+        )
+
+        self.prune_tokenization_cache(cache_dir, fingerprint)
+
+        return doc_dataset
+
+    def prune_tokenization_cache(self, cache_dir, fingerprint):
+        """
+        Keeps only the `TOKENIZATION_CACHE_SIZE` most recently used tokenizations
+        in the cache. Multi-process tokenization writes one file per process.
+
+        """
+        cache_files = defaultdict(list)
+        for cache_file in cache_dir.glob("tokenized_*.arrow"):
+            cache_files[cache_file.stem.split("_")[1]].append(cache_file)
+
+        # Mark the current tokenization as the most recently used
+        for cache_file in cache_files[fingerprint]:
+            os.utime(cache_file)
+
+        stale_fingerprints = sorted(
+            cache_files.keys() - {fingerprint},
+            key=lambda x: max(f.stat().st_mtime for f in cache_files[x]),
+            reverse=True,
+        )[TOKENIZATION_CACHE_SIZE - 1 :]
+
+        for stale_fingerprint in stale_fingerprints:
+            self.log(f"Removing stale tokenization cache: {stale_fingerprint}")
+
+            for cache_file in cache_files[stale_fingerprint]:
+                cache_file.unlink(missing_ok=True)
+
+    def filter_documents(self, doc_dataset, invalid_docs, check_content=False):
+        """
+        Fused document filtering. All checks are computed in a single vectorized
+        pass over the needed Arrow columns, and applied at once using `select`.
+            1. invalid: the doc id is in `invalid_docs`
+            2. all_oov: the doc has no in-vocab tokens (if `check_content`)
+            3. too_short: the doc has fewer than `min_len` tokens (if `check_content`)
+
+        Returns the filtered dataset, the ids of the removed docs, and the number
+        of docs failing each check.
+
+        """
+        columns = ["doc_id"]
+        if check_content and self.feature_type == "one-hot":
+            columns += ["length", "oov_count"]
+        elif check_content and self.feature_type == "lm-embeddings":
+            columns += ["length", "special_tokens_mask"]
+
+        table = doc_dataset.with_format("arrow", columns=columns)[:]
+
+        doc_ids = table["doc_id"].to_pylist()
+
+        failed = dict()
+        failed["invalid"] = np.fromiter(
+            (doc_id in invalid_docs for doc_id in doc_ids),
+            dtype=bool,
+            count=len(doc_ids),
+        )
+
+        if check_content:
+            length = table["length"].to_numpy()
+
+            if self.feature_type == "one-hot":
+                num_content_tokens = length
+                failed["all_oov"] = length <= table["oov_count"].to_numpy()
+
+            elif self.feature_type == "lm-embeddings":
+                # Sum the special tokens mask of each doc, without leaving Arrow
+                special_tokens_mask = table["special_tokens_mask"]
+                mask_values = pc.list_flatten(special_tokens_mask).to_numpy()
+                mask_lengths = pc.list_value_length(special_tokens_mask).to_numpy()
+
+                mask_cumsum = np.concatenate([[0], np.cumsum(mask_values)])
+                mask_ends = np.cumsum(mask_lengths)
+                num_special_tokens = (
+                    mask_cumsum[mask_ends] - mask_cumsum[mask_ends - mask_lengths]
+                )
+
+                num_content_tokens = length - num_special_tokens
+                failed["all_oov"] = length == num_special_tokens
+
+            failed["too_short"] = num_content_tokens < self.min_len
+
+        keep = ~np.any(np.stack(list(failed.values()), axis=0), axis=0)
+
+        removed_docs = {doc_id for doc_id, k in zip(doc_ids, keep) if not k}
+
+        doc_dataset = doc_dataset.select(np.where(keep)[0])
+
+        num_failed = {reason: int(np.sum(mask)) for reason, mask in failed.items()}
+
+        return doc_dataset, removed_docs, num_failed
+
     def sanitize_documents(self):
         """
         Initial cleaning of documents:
@@ -85,6 +211,9 @@ class ContentProcessor(GraphIO):
         doc_dataset = Dataset.from_list(doc_dataset)
         doc_dataset.set_format(type="numpy", columns=["y"])
 
+        # In-memory datasets get a random fingerprint, so hash the content instead
+        content_fingerprint = Hasher.hash((doc2content, doc2labels))
+
         self.log("\nSanitizing...")
         if self.feature_type == "one-hot":
             self.log("Running with a OneHot Tokenizer")
@@ -108,21 +237,9 @@ class ContentProcessor(GraphIO):
                 tokenizer.build_vocab(list(doc2content.values()))
 
             self.log("Tokenizing documents...")
-            doc_dataset = doc_dataset.map(lambda row: tokenizer(row["raw_text"]))
-
-            self.log("Filtering all OOV docs...")
-            all_oov_idx = doc_dataset.filter(
-                lambda row: row["length"] <= row["oov_count"]
-            )["doc_id"]
-            invalid_docs.update(all_oov_idx)
-            num_all_oov = len(all_oov_idx)
-
-            self.log("Filtering too short docs...")
-            too_short_idx = doc_dataset.filter(
-                lambda row: row["length"] < self.min_len
-            )["doc_id"]
-            invalid_docs.update(too_short_idx)
-            num_too_short = len(too_short_idx)
+            doc_dataset = self.tokenize_documents(
+                doc_dataset, tokenizer, content_fingerprint
+            )
 
         elif self.feature_type == "lm-embeddings":
             self.log(f"Running with a LMEmbeddings Tokenizer ({self.compression})")
@@ -134,25 +251,17 @@ class ContentProcessor(GraphIO):
             )
 
             self.log("Tokenizing documents...")
-            doc_dataset = doc_dataset.map(lambda row: tokenizer(row["raw_text"]))
-
-            self.log("Filtering all OOV docs...")
-            all_oov_idx = doc_dataset.filter(
-                lambda row: row["length"] == row["special_tokens_mask"].sum()
-            )["doc_id"]
-            invalid_docs.update(all_oov_idx)
-            num_all_oov = len(all_oov_idx)
-
-            self.log("Filtering too short docs...")
-            too_short_idx = doc_dataset.filter(
-                lambda row: (row["length"] - row["special_tokens_mask"].sum())
-                < self.min_len
-            )["doc_id"]
-            invalid_docs.update(too_short_idx)
-            num_too_short = len(too_short_idx)
-
-        self.log("Applying filters...")
-        doc_dataset = doc_dataset.filter(lambda row: row["doc_id"] not in invalid_docs)
+            doc_dataset = self.tokenize_documents(
+                doc_dataset, tokenizer, content_fingerprint
+            )
+
+        self.log("Filtering invalid, all OOV and too short docs...")
+        doc_dataset, removed_docs, num_failed = self.filter_documents(
+            doc_dataset, invalid_docs, check_content=True
+        )
+        invalid_docs.update(removed_docs)
+        num_all_oov = num_failed["all_oov"]
+        num_too_short = num_failed["too_short"]
 
         doc_lengths = doc_dataset["length"]
 
@@ -468,7 +577,7 @@ class ContentProcessor(GraphIO):
 
         self.log("\nApplying filters to dataset object...")
         pre_filter_num_rows = doc_dataset.num_rows
-        doc_dataset = doc_dataset.filter(lambda row: row["doc_id"] not in invalid_docs)
+        doc_dataset, _, _ = self.filter_documents(doc_dataset, invalid_docs)
         post_filter_num_rows = doc_dataset.num_rows
 
         self.log(
@@ -1,12 +1,15 @@
 import os
 import shutil
 import sys
+import atexit
 import pickle
 from pathlib import Path
+from copy import deepcopy
+from collections import Counter, OrderedDict
 
 import datasets
 from datasets import Dataset
-from scipy.sparse import save_npz, load_npz
+from scipy.sparse import save_npz, load_npz, issparse
 
 from data_prep import (
     SUMMARY_FILE,
@@ -30,6 +33,118 @@ from data_prep import (
 from data_prep.tokenizers import OneHotTokenizer, LMTokenizer
 from utils.io import save_json_file, load_json_file, create_dir
 
+# Artifacts that are only read after being written, shared within a process
+# Preprocessing mutates e.g. `invalid_docs` in place, so those are not cached
+CACHED_FILE_TYPES = {
+    "doc_dataset",
+    "tokenizer",
+    "doc2labels",
+    "doc2nodeid",
+    "user2nodeid",
+    "split_idx",
+    "adj_matrix",
+}
+
+# Debug counter of bytes read from disk, per entry point and file type
+# Only collected in debug mode, as it stats every file of directory artifacts
+GRAPHIO_DEBUG = os.environ.get("GRAPHIO_DEBUG", "0") == "1"
+BYTES_READ = Counter()
+
+
+class ArtifactCache:
+    """
+    Process-wide LRU cache of loaded artifacts, keyed by `(resolved path, mtime)`.
+    A file changing on disk thus never returns a stale object. The size of an
+    artifact is estimated from its size on disk, and least recently used
+    artifacts are evicted once the memory budget is exceeded.
+
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+
+        self._cache = OrderedDict()
+        self._used_bytes = 0
+
+    def get(self, key):
+        if key not in self._cache:
+            return None
+
+        self._cache.move_to_end(key)
+
+        return self._cache[key][0]
+
+    def put(self, key, obj, num_bytes: int):
+        # Too large to ever fit, don't evict everything else for it
+        if num_bytes > self.budget_bytes:
+            return
+
+        self.invalidate(key[0])
+
+        self._cache[key] = (obj, num_bytes)
+        self._used_bytes += num_bytes
+
+        while self._used_bytes > self.budget_bytes:
+            _, (_, evicted_bytes) = self._cache.popitem(last=False)
+            self._used_bytes -= evicted_bytes
+
+    def invalidate(self, path):
+        for key in [key for key in self._cache if key[0] == path]:
+            _, num_bytes = self._cache.pop(key)
+            self._used_bytes -= num_bytes
+
+    def clear(self):
+        self._cache.clear()
+        self._used_bytes = 0
+
+
+ARTIFACT_CACHE = ArtifactCache(
+    budget_bytes=int(os.environ.get("GRAPHIO_CACHE_MB", 2048)) * 2**20
+)
+
+
+def _path_stat(path):
+    # Returns the size and last modification time, over all files for dirs
+    path = Path(path)
+    if path.is_dir():
+        stats = [f.stat() for f in path.rglob("*") if f.is_file()]
+        return (
+            sum(stat.st_size for stat in stats),
+            max((stat.st_mtime_ns for stat in stats), default=0),
+        )
+    elif path.exists():
+        stat = path.stat()
+        return stat.st_size, stat.st_mtime_ns
+    else:
+        return 0, 0
+
+
+def _copy_artifact(obj):
+    # Callers get their own containers, so mutating them can't corrupt the cache
+    # Still far cheaper than reading and parsing the file again
+    if isinstance(obj, dict):
+        # Cached dicts map ids to ids or labels, all immutable
+        return dict(obj)
+    elif isinstance(obj, list):
+        return deepcopy(obj)
+    elif issparse(obj):
+        return obj.copy()
+    else:
+        return obj
+
+
+def log_bytes_read():
+    total = sum(BYTES_READ.values())
+    sys.stdout.write(f"\nBytes read by GraphIO: {total / 2**20:.2f} MiB\n")
+    for (entry_point, file_type), num_bytes in BYTES_READ.most_common():
+        sys.stdout.write(
+            f"\t{entry_point} - {file_type}: {num_bytes / 2**20:.2f} MiB\n"
+        )
+
+
+if GRAPHIO_DEBUG:
+    atexit.register(log_bytes_read)
+
 
 class GraphIO:
     def __init__(
@@ -143,7 +258,19 @@ class GraphIO:
         self.labels = args["labels"]
 
         # The summary stores all preprocessing actions =========================
-        self.summary = self.load_file("summary")
+        # Only loaded once accessed, see `summary`
+        self._summary = None
+
+    @property
+    def summary(self):
+        if self._summary is None:
+            self._summary = self.load_file("summary")
+
+        return self._summary
+
+    @summary.setter
+    def summary(self, summary):
+        self._summary = summary
 
     def change_data_dir(self, args, verbose: bool = True):
         if verbose:
@@ -281,6 +408,8 @@ class GraphIO:
 
         file_path = self._get_file_name(file_type)
 
+        ARTIFACT_CACHE.invalidate(Path(file_path).resolve())
+
         if file_type == "summary":
             with open(file_path, "wb") as f:
                 pickle.dump(self.summary, f)
@@ -319,6 +448,25 @@ class GraphIO:
             raise NotImplementedError(f"Cannot save this file type: `{file_type}`")
 
     def load_file(self, file_type):
+        """
+        Loads a file, going through the process-wide `ARTIFACT_CACHE` for
+        read-only artifacts. Mutable cached artifacts are returned as copies.
+
+        """
+        if file_type not in CACHED_FILE_TYPES:
+            return self._load_file(file_type)
+
+        file_path = Path(self._get_file_name(file_type)).resolve()
+        num_bytes, mtime = _path_stat(file_path)
+
+        obj = ARTIFACT_CACHE.get((file_path, mtime))
+        if obj is None:
+            obj = self._load_file(file_type)
+            ARTIFACT_CACHE.put((file_path, mtime), obj, num_bytes)
+
+        return _copy_artifact(obj)
+
+    def _load_file(self, file_type):
         file_path = self._get_file_name(file_type)
 
         if file_type == "summary":
@@ -362,4 +510,7 @@ class GraphIO:
         else:
             raise NotImplementedError(f"Cannot load this file type: `{file_type}`")
 
+        if GRAPHIO_DEBUG:
+            BYTES_READ[(Path(sys.argv[0]).stem, file_type)] += _path_stat(file_path)[0]
+
         return obj
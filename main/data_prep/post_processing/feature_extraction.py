@@ -1,8 +1,10 @@
 import os
+import warnings
 
+import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
 from lightning_lite import seed_everything
 import datasets
@@ -201,19 +203,9 @@ def train_feature_extractor(
     )
 
     if args["data"]["num_splits"] > 0:
-        train_loader = DataLoader(
-            train_dataset,
-            batch_size=args["feature_extraction"]["batch_size"],
-            collate_fn=train_dataset.collate_fn,
-            shuffle=True,
-        )
+        train_loader = get_feature_extraction_loader(args, train_dataset, shuffle=True)
 
-        val_loader = DataLoader(
-            val_dataset,
-            batch_size=args["feature_extraction"]["batch_size"],
-            collate_fn=val_dataset.collate_fn,
-            shuffle=False,
-        )
+        val_loader = get_feature_extraction_loader(args, val_dataset, shuffle=False)
 
     test_dataset = FeatureExtractorDataset(
         args["data"],
@@ -232,6 +224,27 @@ def train_feature_extractor(
         p_mask_token=args["feature_extraction"]["p_mask_token"],
     ).to(device)
 
+    if (
+        args["data"]["feature_type"] == "lm-embeddings"
+        and args["feature_extraction"]["cache_lm_embeddings"]
+    ):
+        # The LM is frozen, so its embeddings only need to be computed once
+        # Note that this disables token masking for the LM inputs
+        if args["feature_extraction"]["p_mask_token"] > 0:
+            warnings.warn(
+                "Caching LM embeddings disables token masking "
+                f"(p_mask_token={args['feature_extraction']['p_mask_token']}). "
+                "Set `feature_extraction.cache_lm_embeddings=false` to train "
+                "with token masking."
+            )
+
+        cache_lm_embeddings(
+            args,
+            [train_dataset, val_dataset, test_dataset],
+            feature_extractor,
+            device=device,
+        )
+
     optimizer = torch.optim.AdamW(
         feature_extractor.parameters(),
         lr=args["feature_extraction"]["lr"],
@@ -338,12 +351,7 @@ def train_feature_extractor(
         split_embeddings = []
         split_targets = []
 
-        loader = DataLoader(
-            dataset,
-            batch_size=args["feature_extraction"]["batch_size"],
-            collate_fn=dataset.collate_fn,
-            shuffle=False,
-        )
+        loader = get_feature_extraction_loader(args, dataset, shuffle=False)
 
         prog_bar_updates = max(len(loader) // args["feature_extraction"]["prog_bar"], 1)
 
@@ -378,9 +386,9 @@ def train_feature_extractor(
                 pbar.update(i - prev_i)
                 prev_i = i
 
-        split_node_ids = torch.cat(split_node_ids, dim=0)
-        split_embeddings = torch.cat(split_embeddings, dim=0)
-        split_targets = torch.cat(split_targets, dim=0)
+        split_node_ids = to_dataset_order(loader, torch.cat(split_node_ids, dim=0))
+        split_embeddings = to_dataset_order(loader, torch.cat(split_embeddings, dim=0))
+        split_targets = to_dataset_order(loader, torch.cat(split_targets, dim=0))
 
         split_dataset = datasets.Dataset.from_dict(
             {
@@ -440,6 +448,160 @@ def train_feature_extractor(
     )
 
 
+def get_feature_extraction_loader(args, dataset, shuffle: bool = False):
+    max_tokens = args["feature_extraction"]["max_tokens_per_batch"]
+
+    # Padded LM inputs are batched by length, under a budget of (padded) tokens
+    if (
+        dataset.feature_type == "lm-embeddings"
+        and dataset.lm_embeddings is None
+        and max_tokens is not None
+    ):
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths=dataset.lengths,
+            max_tokens=max_tokens,
+            shuffle=shuffle,
+        )
+
+        return DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=dataset.collate_fn,
+        )
+
+    return DataLoader(
+        dataset,
+        batch_size=args["feature_extraction"]["batch_size"],
+        collate_fn=dataset.collate_fn,
+        shuffle=shuffle,
+    )
+
+
+def to_dataset_order(loader, rows):
+    """
+    Reorders rows, concatenated over all batches of a non-shuffled `loader`,
+    back into the order of its dataset. Token-budget batches are sorted by
+    length, so their rows would otherwise not line up with the dataset.
+
+    """
+    if not isinstance(loader.batch_sampler, TokenBudgetBatchSampler):
+        return rows
+
+    assert not loader.batch_sampler.shuffle, "Can only reorder a non-shuffled loader."
+
+    sampled_idx = torch.tensor(
+        [idx for batch in loader.batch_sampler for idx in batch], dtype=torch.long
+    )
+
+    ordered_rows = torch.empty_like(rows)
+    ordered_rows[sampled_idx] = rows
+
+    return ordered_rows
+
+
+def cache_lm_embeddings(args, split_datasets, feature_extractor, device):
+    """
+    Runs the frozen LM once over all documents, and stores the mean hidden states
+    as a memory-mapped float16 array, indexed by node id. Shared by all folds.
+    Afterwards, the datasets provide the cached embeddings instead of tokens.
+
+    """
+    dataset = split_datasets[0]
+
+    if not dataset._lm_embeddings_path().exists():
+        print("Caching LM embeddings...")
+        num_docs = len(dataset.load_file("doc2nodeid"))
+
+        embeddings = np.zeros(
+            (num_docs, feature_extractor.compressed_size), dtype=np.float16
+        )
+
+        feature_extractor.eval()
+
+        for split_dataset in split_datasets:
+            loader = get_feature_extraction_loader(args, split_dataset, shuffle=False)
+
+            for node_ids, x, _ in tqdm(
+                loader, desc=f"Embedding {split_dataset.split} split"
+            ):
+                x = {k: v.to(device) for k, v in x.items()}
+
+                with torch.inference_mode():
+                    out = feature_extractor.compress(x)
+
+                embeddings[node_ids.numpy()] = out.cpu().numpy()
+
+        dataset.save_file(file_type="lm_embeddings", obj=embeddings)
+
+    lm_embeddings = dataset.load_file(file_type="lm_embeddings")
+    for split_dataset in split_datasets:
+        split_dataset.lm_embeddings = lm_embeddings
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Groups documents of similar length into batches, such that the padded batch
+    holds at most `max_tokens` tokens.
+
+    If shuffling, documents are first shuffled into buckets of `bucket_size`
+    documents, and only sorted by length within each bucket. The order of the
+    batches is shuffled as well.
+
+    """
+
+    def __init__(
+        self, lengths, max_tokens: int, shuffle: bool = False, bucket_size: int = 4096
+    ):
+        self.lengths = torch.as_tensor(lengths, dtype=torch.long)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+        self._batches = self._generate_batches()
+
+    def _generate_batches(self):
+        if self.shuffle:
+            idx = torch.randperm(self.lengths.shape[0])
+            buckets = torch.split(idx, self.bucket_size)
+        else:
+            buckets = [torch.arange(self.lengths.shape[0])]
+
+        batches = []
+        for bucket in buckets:
+            # Sort by length within the bucket, stable to keep ties in order
+            bucket_lengths, order = torch.sort(self.lengths[bucket], stable=True)
+
+            batch = []
+            for i, length in zip(bucket[order].tolist(), bucket_lengths.tolist()):
+                # Sorted, so the current document sets the padded length
+                # Close the batch if it would overflow, unless it is still empty
+                if len(batch) > 0 and length * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+
+                batch.append(i)
+
+            if len(batch) > 0:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        return batches
+
+    def __iter__(self):
+        batches = self._batches
+
+        # Reshuffle ahead of time, so `len` is exact for the next epoch too
+        if self.shuffle:
+            self._batches = self._generate_batches()
+
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches)
+
+
 class FeatureExtractorDataset(PostProcessing, Dataset):
     def __init__(self, args, cur_fold: int, split: str, **super_kwargs):
         super().__init__(
@@ -458,6 +620,9 @@ class FeatureExtractorDataset(PostProcessing, Dataset):
 
         self.idx = [i for i in range(self.data.num_rows)]
 
+        # Optionally replaced by pre-computed LM embeddings, indexed by node id
+        self.lm_embeddings = None
+
         if args["feature_type"] == "lm-embeddings":
             self.feature_type = "lm-embeddings"
             tokenizer = self.load_file("tokenizer")
@@ -468,7 +633,12 @@ class FeatureExtractorDataset(PostProcessing, Dataset):
         batch = self.data[batch]
         y = torch.tensor(batch["y"])
 
-        if self.feature_type == "lm-embeddings":
+        if self.feature_type == "lm-embeddings" and self.lm_embeddings is not None:
+            embeddings = torch.from_numpy(self.lm_embeddings[node_ids.numpy()])
+
+            return node_ids, {"embeddings": embeddings}, y
+
+        elif self.feature_type == "lm-embeddings":
             model_inputs = dict()
             for k, v in batch.items():
                 v = list(map(torch.tensor, v))
@@ -484,12 +654,27 @@ class FeatureExtractorDataset(PostProcessing, Dataset):
             return node_ids, model_inputs, y
 
         elif self.feature_type == "one-hot":
-            batch_size = batch["input_ids"].shape[0]
-            model_inputs = torch.zeros((batch_size, self.vocab_size))
-            for row, present_tokens in enumerate(batch["input_ids"]):
-                model_inputs[row][present_tokens] = 1.0
+            # Sparse (CSR) representation of the one-hot matrix
+            # Avoids materializing a batch_size x vocab_size tensor
+            present_tokens = [
+                torch.as_tensor(tokens, dtype=torch.long)
+                for tokens in batch["input_ids"]
+            ]
+
+            lengths = torch.tensor([tokens.shape[0] for tokens in present_tokens])
+            offsets = torch.cumsum(lengths, dim=0) - lengths
+
+            model_inputs = {
+                "indices": torch.cat(present_tokens),
+                "offsets": offsets,
+            }
+
+            return node_ids, model_inputs, y
 
-            return node_ids, {"model_input": model_inputs}, y
+    @property
+    def lengths(self):
+        # Number of tokens per document, used for length-bucketed batching
+        return np.asarray(self.data["length"], dtype=np.int64).reshape(-1)
 
     def __getitem__(self, index):
         return self.idx[index]
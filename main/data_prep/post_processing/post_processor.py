@@ -1,14 +1,22 @@
 import os
 import sys
+import json
+import shutil
 import pickle
+import hashlib
 
+import numpy as np
 import torch
 from datasets import load_from_disk
+from torch_geometric.data import Data
 
-from data_prep import LOG_FILE
+from data_prep import LOG_FILE, LM_EMBEDDINGS_FILE, FEATURE_EXTRACTOR_HPARAMS_FILE
 from data_prep.graph_io import GraphIO
 from models import FeatureExtractor
 
+# Version of the on-disk format used by `PostProcessing.save`
+STRUCTURED_FORMAT_VERSION = 1
+
 
 class PostProcessing(GraphIO):
     def __init__(
@@ -18,8 +26,6 @@ class PostProcessing(GraphIO):
 
         super().__init__(args, version=version, enforce_raw=False, **super_kwargs)
 
-        self.fold_idx = self.load_file("split_idx")[self.cur_fold]
-
         os.makedirs(self.data_processed_path(), exist_ok=True)
         os.makedirs(self.data_structure_path(), exist_ok=True)
 
@@ -30,24 +36,96 @@ class PostProcessing(GraphIO):
                 "`processed_or_structured` must be one of {'processed', 'structured'}"
             )
 
+    @property
+    def fold_idx(self):
+        return self.load_file("split_idx")[self.cur_fold]
+
     def data_processed_path(self, *parts):
         return super().data_processed_path(str(self.cur_fold), *parts)
 
     def data_structure_path(self, *parts):
         return super().data_structure_path(str(self.cur_fold), *parts)
 
+    def _lm_embeddings_path(self):
+        # The pre-trained LM is frozen, so its embeddings are shared by all folds
+        return super().data_processed_path(LM_EMBEDDINGS_FILE)
+
+    @staticmethod
+    def content_hash(*objs):
+        # Hashes arrays by their raw contents, anything else by its repr
+        hasher = hashlib.sha1()
+        for obj in objs:
+            if isinstance(obj, torch.Tensor):
+                obj = obj.cpu().numpy()
+
+            if isinstance(obj, np.ndarray):
+                hasher.update(f"{obj.dtype}{obj.shape}".encode())
+                hasher.update(np.ascontiguousarray(obj).tobytes())
+            else:
+                hasher.update(repr(obj).encode())
+
+        return hasher.hexdigest()
+
+    def cached(self, name: str, key: str, compute_fn):
+        """
+        Content-hashed cache for fold-independent results, shared by all folds.
+        Returns the stored result if one exists for `key`, otherwise computes
+        and stores it. Results are saved using `torch.save`.
+
+        """
+        cache_path = super().data_processed_path("cache", f"{name}_{key}.pt")
+
+        if cache_path.exists():
+            self.log(f"Loading cached {name}")
+            return torch.load(cache_path)
+
+        obj = compute_fn()
+
+        # Write to a temporary file first, to avoid leaving partial caches
+        os.makedirs(cache_path.parent, exist_ok=True)
+        tmp_cache_path = cache_path.with_suffix(".tmp")
+        torch.save(obj, tmp_cache_path)
+        os.replace(tmp_cache_path, cache_path)
+
+        return obj
+
     def save_file(self, file_type, obj=None):
         if file_type == "feature_extractor":
             torch.save(obj, self.data_processed_path("feature_extractor.pt"))
 
+            # Sidecar, so hyperparameters can be read without loading weights
+            with open(
+                self.data_processed_path(FEATURE_EXTRACTOR_HPARAMS_FILE), "w"
+            ) as f:
+                json.dump(obj["hparams"], f)
+
         elif file_type == "compressed_dataset":
             obj.save_to_disk(self.data_processed_path())
 
+        elif file_type == "lm_embeddings":
+            # Write to a temporary file first, to avoid leaving partial caches
+            file_path = self._lm_embeddings_path()
+            tmp_file_path = file_path.with_suffix(".tmp.npy")
+
+            np.save(tmp_file_path, obj.astype(np.float16))
+
+            os.replace(tmp_file_path, file_path)
+
         else:
             super().save_file(file_type, obj)
 
-    def load_file(self, file_type):
-        if file_type == "feature_extractor":
+    def _load_file(self, file_type):
+        if file_type == "feature_extractor_hparams":
+            file_path = self.data_processed_path(FEATURE_EXTRACTOR_HPARAMS_FILE)
+
+            if file_path.exists():
+                with open(file_path, "r") as f:
+                    obj = json.load(f)
+            else:
+                # Saved before the sidecar existed
+                obj = self._load_file("feature_extractor").hparams
+
+        elif file_type == "feature_extractor":
             state_dict = torch.load(
                 self.data_processed_path("feature_extractor.pt"),
                 map_location="cpu",
@@ -59,45 +137,209 @@ class PostProcessing(GraphIO):
         elif file_type == "compressed_dataset":
             obj = load_from_disk(self.data_processed_path())
 
+        elif file_type == "lm_embeddings":
+            # Memory-mapped, rows are only read when accessed
+            obj = np.load(self._lm_embeddings_path(), mmap_mode="r")
+
         else:
-            obj = super().load_file(file_type)
+            obj = super()._load_file(file_type)
 
         return obj
 
     @property
     def _file_name(self):
+        # Legacy format, the whole `__dict__` in a single pickle
         return self.__str__().lower() + ".pickle"
 
-    def save(self):
+    @property
+    def _dir_name(self):
+        return self.__str__().lower()
+
+    def _save_path(self, *parts):
         if self.processed_or_structured == "processed":
-            save_path = self.data_processed_path(self._file_name)
+            return self.data_processed_path(*parts)
         elif self.processed_or_structured == "structured":
-            save_path = self.data_structure_path(self._file_name)
+            return self.data_structure_path(*parts)
+
+    def save(self):
+        """
+        Saves the instance's attributes in a versioned, per-attribute format:
+            - tensors, and the tensors of graphs, as separate `.npy` files
+            - JSON-serializable attributes in `metadata.json`
+            - everything else in a separate pickle per attribute
+        Loading is lazy, only the attributes that are used get read.
+
+        """
+        save_dir = self._save_path(self._dir_name)
+
+        # Make sure lazily loaded attributes are included
+        for k in list(self.__dict__.get("_lazy_attributes", dict()).keys()):
+            getattr(self, k)
+
+        if save_dir.exists():
+            shutil.rmtree(save_dir)
+        os.makedirs(save_dir)
+
+        metadata = {
+            "format_version": STRUCTURED_FORMAT_VERSION,
+            "class": type(self).__name__,
+            "attributes": dict(),
+        }
+        for k, v in self.__dict__.items():
+            if k == "_lazy_attributes":
+                continue
+
+            metadata["attributes"][k] = self._save_attribute(save_dir, k, v)
+
+        with open(save_dir / "metadata.json", "w") as f:
+            json.dump(metadata, f)
+
+    @staticmethod
+    def _save_tensor(file_path, tensor):
+        tensor = tensor.detach().cpu()
+        np.save(file_path, tensor.numpy())
 
-        with open(save_path, "wb") as f:
-            pickle.dump(self.__dict__, f)
+        return {"file": file_path.name, "shape": list(tensor.shape)}
+
+    def _save_attribute(self, save_dir, name, value):
+        if isinstance(value, torch.Tensor):
+            return {
+                "kind": "tensor",
+                **self._save_tensor(save_dir / f"{name}.npy", value),
+            }
+
+        elif isinstance(value, Data):
+            graph_dir = save_dir / name
+            os.makedirs(graph_dir)
+
+            tensors, other = dict(), dict()
+            for k, v in value:
+                if isinstance(v, torch.Tensor):
+                    tensors[k] = self._save_tensor(graph_dir / f"{k}.npy", v)
+                else:
+                    other[k] = v
+
+            with open(graph_dir / "other.pickle", "wb") as f:
+                pickle.dump(other, f)
+
+            return {"kind": "graph", "dir": name, "tensors": tensors}
+
+        # Only kept in the metadata if it survives a JSON round trip unchanged
+        try:
+            if json.loads(json.dumps(value)) == value:
+                return {"kind": "json", "value": value}
+        except (TypeError, ValueError):
+            pass
+
+        with open(save_dir / f"{name}.pickle", "wb") as f:
+            pickle.dump(value, f)
+
+        return {"kind": "pickle", "file": f"{name}.pickle"}
+
+    @staticmethod
+    def _load_tensor(file_path, spec):
+        # Memory-mapped copy-on-write, only pages that are used get read
+        # Empty and scalar arrays cannot be memory-mapped
+        if len(spec["shape"]) > 0 and np.prod(spec["shape"]) > 0:
+            array = np.load(file_path, mmap_mode="c")
+        else:
+            array = np.load(file_path)
+
+        return torch.from_numpy(array)
+
+    def _load_attribute(self, save_dir, spec):
+        if spec["kind"] == "tensor":
+            return self._load_tensor(save_dir / spec["file"], spec)
+
+        elif spec["kind"] == "graph":
+            graph_dir = save_dir / spec["dir"]
+
+            with open(graph_dir / "other.pickle", "rb") as f:
+                attributes = pickle.load(f)
+
+            for k, tensor_spec in spec["tensors"].items():
+                attributes[k] = self._load_tensor(
+                    graph_dir / tensor_spec["file"], tensor_spec
+                )
+
+            return Data(**attributes)
+
+        elif spec["kind"] == "pickle":
+            with open(save_dir / spec["file"], "rb") as f:
+                return pickle.load(f)
+
+        else:
+            raise ValueError(f"Unknown attribute kind: `{spec['kind']}`")
+
+    def __getattr__(self, name):
+        # Only called if `name` is not found as usual, i.e. not loaded yet
+        lazy_attributes = self.__dict__.get("_lazy_attributes", dict())
+
+        if name in lazy_attributes:
+            value = self._load_attribute(*lazy_attributes.pop(name))
+            setattr(self, name, value)
+
+            return value
+
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'"
+        )
+
+    @classmethod
+    def _is_read_only(cls, name):
+        # Derived attributes, e.g. `fold_idx`, are not restored from older saves
+        attribute = getattr(cls, name, None)
+
+        return isinstance(attribute, property) and attribute.fset is None
 
     @classmethod
     def load(cls, *args, **kwargs):
         instance = cls(*args, **kwargs)
 
-        if instance.processed_or_structured == "processed":
-            save_path = instance.data_processed_path(instance._file_name)
-        elif instance.processed_or_structured == "structured":
-            save_path = instance.data_structure_path(instance._file_name)
+        save_dir = instance._save_path(instance._dir_name)
+        save_path = instance._save_path(instance._file_name)
+
+        if (save_dir / "metadata.json").exists():
+            instance.log(f"Loading from:\n\t{save_dir}")
+
+            with open(save_dir / "metadata.json", "r") as f:
+                metadata = json.load(f)
+
+            if metadata["format_version"] != STRUCTURED_FORMAT_VERSION:
+                raise ValueError(
+                    f"Found format version {metadata['format_version']}, expected"
+                    f" {STRUCTURED_FORMAT_VERSION}. Please re-run structuring."
+                )
+
+            lazy_attributes = dict()
+            for k, spec in metadata["attributes"].items():
+                if instance._is_read_only(k):
+                    continue
+
+                if spec["kind"] == "json":
+                    instance.__setattr__(k, spec["value"])
+                else:
+                    # Remove any value set in `__init__`, so `__getattr__` is used
+                    instance.__dict__.pop(k, None)
+                    lazy_attributes[k] = (save_dir, spec)
+
+            instance._lazy_attributes = lazy_attributes
+
+            return instance
 
-        if save_path.exists():
+        elif save_path.exists():
             instance.log(f"Loading from:\n\t{save_path}")
 
             with open(save_path, "rb") as f:
                 state_dict = pickle.load(f)
 
             for k, v in state_dict.items():
-                instance.__setattr__(k, v)
+                if not instance._is_read_only(k):
+                    instance.__setattr__(k, v)
 
             return instance
         else:
-            raise ValueError(f"No file found at:\n\t{save_path}")
+            raise ValueError(f"No file found at:\n\t{save_dir}")
 
     def log(self, log_string):
         if self.processed_or_structured == "processed":
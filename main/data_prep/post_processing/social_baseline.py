@@ -1,6 +1,7 @@
 import os
-from collections import defaultdict
 
+import numpy as np
+from scipy.sparse import csr_matrix
 import torch
 import torch.nn.functional as F
 
@@ -15,24 +16,24 @@ from utils.metrics import (
 
 
 def train_social_baseline(args, version):
-    all_train_metrics = []
-    all_val_metrics = []
-    all_test_metrics = []
-    for fold in range(args["data"]["num_splits"]):
-        social_baseline = SocialBaseline(
-            args=args["data"],
-            cur_fold=fold,
-            version=version,
-        )
+    # All folds are trained and evaluated in a single batched pass
+    social_baseline = SocialBaseline(
+        args=args["data"],
+        cur_fold=0,
+        version=version,
+    )
 
-        (train_docs, val_docs, test_docs), (
-            train_labels,
-            val_labels,
-            test_labels,
-        ) = social_baseline.get_features_and_labels()
+    split_idx = social_baseline.load_file("split_idx")[: args["data"]["num_splits"]]
 
-        social_baseline.train(train_docs)
+    social_baseline.train([fold_idx["train"] for fold_idx in split_idx])
 
+    # num_docs x num_folds x num_labels
+    all_probs = social_baseline.predict_proba()
+
+    all_train_metrics = []
+    all_val_metrics = []
+    all_test_metrics = []
+    for fold, fold_idx in enumerate(split_idx):
         split_metrics = dict()
 
         results_dir = get_results_dir(
@@ -44,13 +45,9 @@ def train_social_baseline(args, version):
         )
         os.makedirs(results_dir, exist_ok=True)
 
-        for split, split_features, split_labels in zip(
-            ["train", "val", "test"],
-            [train_docs, val_docs, test_docs],
-            [train_labels, val_labels, test_labels],
-        ):
-            probs = social_baseline.predict_proba(split_features, split_labels)
-            split_labels = torch.tensor(split_labels)
+        for split in ["train", "val", "test"]:
+            probs = all_probs[fold_idx[split], fold]
+            split_labels = social_baseline.doc_labels[fold_idx[split]]
 
             split_metrics[split] = {
                 "loss": F.cross_entropy(probs, split_labels),
@@ -117,6 +114,17 @@ def train_social_baseline(args, version):
 
 
 class SocialBaseline(PostProcessing):
+    """
+    Classifies documents by the label distribution of the documents their users
+    interacted with in training. Falls back onto the label prior if none of a
+    document's users were seen in training.
+
+    Uses a sparse doc x user incidence matrix, so that:
+        user_props = row_normalize(incidence.T @ onehot(labels))
+        doc_props = incidence @ user_props / num_seen_users
+
+    """
+
     def __init__(self, args, cur_fold, **super_kwargs):
         super().__init__(
             args, cur_fold, processed_or_structured="processed", **super_kwargs
@@ -124,85 +132,94 @@ class SocialBaseline(PostProcessing):
 
         self.num_labels = len(self.labels)
 
-    def get_features_and_labels(self):
-        doc_dataset = self.load_file("doc_dataset")
+        self.incidence = None
 
-        train_docs = doc_dataset.select(self.fold_idx["train"])
-        train_labels = train_docs["y"]
-        train_docs = train_docs["doc_id"]
-
-        val_docs = doc_dataset.select(self.fold_idx["val"])
-        val_labels = val_docs["y"]
-        val_docs = val_docs["doc_id"]
-
-        test_docs = doc_dataset.select(self.fold_idx["test"])
-        test_labels = test_docs["y"]
-        test_docs = test_docs["doc_id"]
-
-        return (
-            train_docs,
-            val_docs,
-            test_docs,
-        ), (
-            train_labels,
-            val_labels,
-            test_labels,
+    def build_incidence(self):
+        doc_dataset = self.load_file("doc_dataset")
+        doc2users = self.load_file("doc2users")
+        invalid_users = self.load_file("invalid_users")
+
+        self.doc_ids = doc_dataset["doc_id"]
+        self.doc_labels = torch.tensor(doc_dataset["y"])
+
+        # Rows are the docs in `doc_dataset`, columns are all valid users
+        user2idx = dict()
+        rows, cols = [], []
+        for row, doc_id in enumerate(self.doc_ids):
+            for user_id in doc2users.get(doc_id, set()) - invalid_users:
+                rows.append(row)
+                cols.append(user2idx.setdefault(user_id, len(user2idx)))
+
+        self.incidence = csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(self.doc_ids), len(user2idx)),
         )
 
-    def train(self, train_docs):
+    def train(self, train_idx_per_fold):
+        """
+        Computes the user label distributions and label priors for many folds at
+        once. Expects, for each fold, the indices of the training docs.
+
+        """
+        if self.incidence is None:
+            self.build_incidence()
+
         invalid_docs = self.load_file("invalid_docs")
-        self.invalid_users = self.load_file("invalid_users")
-        self.doc2users = self.load_file("doc2users")
-        doc2label = self.load_file("doc2labels")
 
-        self.prior = [0 for _ in range(self.num_labels)]
+        num_docs, num_folds = self.incidence.shape[0], len(train_idx_per_fold)
+
+        # Only docs with any valid users count towards the user props and prior
+        has_users = self.incidence.getnnz(axis=1) > 0
+        onehot_labels = F.one_hot(self.doc_labels, self.num_labels).numpy()
 
-        self.user_prop = defaultdict(lambda: [0 for _ in range(self.num_labels)])
-        for doc_id in train_docs:
-            if doc_id in invalid_docs:
+        # num_docs x (num_folds * num_labels)
+        fold_labels = np.zeros((num_docs, num_folds, self.num_labels), np.float32)
+        for fold, train_idx in enumerate(train_idx_per_fold):
+            train_idx = np.asarray(train_idx, dtype=np.int64)
+
+            if any(self.doc_ids[i] in invalid_docs for i in train_idx):
                 print("Found an invalid doc!")
 
-            incident_users = self.doc2users.get(doc_id, set()) - self.invalid_users
-            if len(incident_users) == 0:
-                continue
-
-            label = doc2label[doc_id]
-            for user_id in incident_users:
-                self.user_prop[user_id][label] += 1
-
-            self.prior[label] += 1
-
-        self.user_prop = dict(self.user_prop)
-        for user_id, prop in self.user_prop.items():
-            prop = torch.tensor(prop)
-            self.user_prop[user_id] = prop / prop.sum()
-
-        self.prior = torch.tensor(self.prior)
-        self.prior = self.prior / self.prior.sum()
-
-    def predict_proba(self, docs, labels):
-        probs = []
-        for doc_id in docs:
-            incident_users = self.doc2users.get(doc_id, set()) - self.invalid_users
-
-            if len(incident_users) == 0:
-                n = 1
-                prob = self.prior
-            else:
-                n = 0
-                prob = torch.zeros((self.num_labels,))
-                for user_id in incident_users:
-                    if user_id in self.user_prop:
-                        prob += self.user_prop[user_id]
-                        n += 1
-                # In case none of the incident users for this document have been seen before
-                # Fal back onto prior
-                if n == 0:
-                    n = 1
-                    prob = self.prior
-
-            probs.append(prob / n)
-
-        probs = torch.stack(probs)
-
-        return probs
+            train_idx = train_idx[has_users[train_idx]]
+            fold_labels[train_idx, fold] = onehot_labels[train_idx]
+
+        fold_labels = fold_labels.reshape(num_docs, num_folds * self.num_labels)
+
+        # num_users x num_folds x num_labels
+        user_counts = self.incidence.T @ fold_labels
+        user_counts = user_counts.reshape(-1, num_folds, self.num_labels)
+
+        user_totals = user_counts.sum(axis=-1, keepdims=True)
+
+        # num_users x num_folds
+        self.user_seen = (user_totals[..., 0] > 0).astype(np.float32)
+        self.user_props = user_counts / np.maximum(user_totals, 1)
+
+        # num_folds x num_labels
+        prior = fold_labels.reshape(num_docs, num_folds, self.num_labels).sum(axis=0)
+        self.prior = prior / prior.sum(axis=-1, keepdims=True)
+
+    def predict_proba(self):
+        """
+        Predicts the label distribution of all docs, for all trained folds.
+        Returns a tensor of shape num_docs x num_folds x num_labels.
+
+        """
+        num_docs, num_folds = self.incidence.shape[0], self.user_seen.shape[1]
+
+        # Mean over the incident users seen in training
+        num_seen_users = self.incidence @ self.user_seen
+
+        probs = self.incidence @ self.user_props.reshape(
+            -1, num_folds * self.num_labels
+        )
+        probs = probs.reshape(num_docs, num_folds, self.num_labels)
+        probs = probs / np.maximum(num_seen_users, 1)[..., np.newaxis]
+
+        # In case none of the incident users for a document have been seen before
+        # Fall back onto prior
+        probs = np.where(
+            (num_seen_users == 0)[..., np.newaxis], self.prior[np.newaxis], probs
+        )
+
+        return torch.tensor(probs, dtype=torch.float32)
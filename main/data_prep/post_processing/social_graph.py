@@ -1,4 +1,5 @@
 import time
+from itertools import compress
 
 import numpy as np
 import torch
@@ -86,8 +87,14 @@ class SocialGraph(PostProcessing):
         adj_matrix = self.load_file("adj_matrix")
         num_nodes = adj_matrix.shape[0]
 
-        edge_index, _ = from_scipy_sparse_matrix(adj_matrix)
-        edge_index = coalesce(edge_index)
+        # The graph structure is shared by all folds, only compute it once
+        edge_index = self.cached(
+            "edge_index",
+            key=self.content_hash(
+                adj_matrix.indptr, adj_matrix.indices, adj_matrix.shape
+            ),
+            compute_fn=lambda: coalesce(from_scipy_sparse_matrix(adj_matrix)[0]),
+        )
 
         node_ids = []
         features = []
@@ -159,106 +166,87 @@ class SocialGraph(PostProcessing):
 
         # Decide which nodes we keep based on the mode and split used ==========
         if self.structure_mode == "transductive":
-            doc_nodes_to_keep = [
-                graph_id
-                for graph_id, split in zip(self.graph.idx, self.graph.splits)
-                if split in set(self.splits)
-            ]
+            doc_splits_to_keep = list(self.splits)
 
         elif self.structure_mode == "inductive":
-            doc_nodes_to_keep = [
-                graph_id
-                for graph_id, split in zip(self.graph.idx, self.graph.splits)
-                if split == self.split
-            ]
+            doc_splits_to_keep = [self.split]
 
         elif self.structure_mode == "augmented":
-            doc_nodes_to_keep = [
-                graph_id
-                for graph_id, split in zip(self.graph.idx, self.graph.splits)
-                if split in {"train", self.split}
-            ]
-
-        doc_nodes_to_keep = torch.stack(doc_nodes_to_keep, dim=0)
+            doc_splits_to_keep = ["train", self.split]
 
-        # Now for users
-        user_nodes_to_keep = [
-            graph_id
-            for graph_id, split in zip(self.graph.idx, self.graph.splits)
-            if split == "user"
-        ]
-        user_nodes_to_keep = torch.stack(user_nodes_to_keep)
+        # Users are always kept
+        node_splits = np.array(self.graph.splits)
+        is_user = node_splits == "user"
 
-        nodes_to_keep = torch.cat([doc_nodes_to_keep, user_nodes_to_keep])
+        keep_mask = is_user | np.isin(node_splits, doc_splits_to_keep)
 
-        split_graph = self.graph.subgraph(nodes_to_keep)
+        # Docs precede users, so kept docs come first
+        nodes_to_keep = torch.from_numpy(np.flatnonzero(keep_mask))
 
-        self.log(f"\nKept {split_graph.num_nodes}/{self.graph.num_nodes} nodes.")
+        self.log(f"\nKept {nodes_to_keep.shape[0]}/{self.graph.num_nodes} nodes.")
         self.log(
-            f"Removed {self.graph.num_nodes - split_graph.num_nodes} nodes with different split."
+            f"Removed {self.graph.num_nodes - nodes_to_keep.shape[0]} nodes with different split."
         )
 
         # Check the connected components ===============================================
         # Remove some CCs if too many
         # Most are just isolated users now
-        num_docs = doc_nodes_to_keep.shape[0]
+        num_docs = int(np.sum(keep_mask & ~is_user))
 
-        adj = to_scipy_sparse_matrix(
-            split_graph.edge_index, num_nodes=split_graph.num_nodes
+        # Only depends on the kept nodes, e.g. shared by all transductive folds
+        num_components, component = self.cached(
+            "connected_components",
+            key=self.content_hash(self.graph.edge_index, nodes_to_keep),
+            compute_fn=lambda: self._connected_components(nodes_to_keep),
         )
+        component = component.numpy()
 
-        num_components, component = sp.csgraph.connected_components(
-            adj,
-            connection="weak",
-        )
         self.log(f"\nSplit generates {num_components} connected components.")
 
         if num_components == 1:
             self.log("Keeping all connected components.")
-            subset = np.ones_like(nodes_to_keep).astype(bool)
+            subset = np.ones_like(component, dtype=bool)
 
         elif self.keep_cc == "all_docs":
             self.log("Keeping all connected components containing a document node.")
-            components_to_keep = np.unique(component[:num_docs])
-            subset = np.in1d(component, components_to_keep)
+            components_to_keep = np.zeros((num_components,), dtype=bool)
+            components_to_keep[component[:num_docs]] = True
+            subset = components_to_keep[component]
 
         elif self.keep_cc == "largest":
             self.log("Keeping only the largest connected component.")
-            _, count = np.unique(component, return_counts=True)
-            subset = np.in1d(component, count.argsort()[-1:])
+            # Same tie-break between equally large components as before
+            count = np.bincount(component, minlength=num_components)
+            subset = component == count.argsort()[-1]
 
         else:
             raise ValueError(f"CC pruning methods {self.keep_cc} not recognized.")
 
+        # Compose the split and CC masks
         prev_keep_nodes = nodes_to_keep.shape[0]
-        nodes_to_keep = nodes_to_keep[subset]
+        keep_mask[nodes_to_keep.numpy()[~subset]] = False
+        nodes_to_keep = nodes_to_keep[torch.from_numpy(subset)]
         cur_keep_nodes = nodes_to_keep.shape[0]
         self.log(f"\nKept {cur_keep_nodes}/{prev_keep_nodes} nodes.")
         self.log(f"Removed {prev_keep_nodes - cur_keep_nodes} nodes in wrong CC.")
 
         split_graph = self.graph.subgraph(nodes_to_keep)
 
-        nodes_to_keep_set = set(nodes_to_keep.tolist())
-        split_graph.splits = [
-            split for i, split in enumerate(self.graph.splits) if i in nodes_to_keep_set
-        ]
-        split_graph.node_ids = [
-            split
-            for i, split in enumerate(self.graph.node_ids)
-            if i in nodes_to_keep_set
-        ]
+        split_graph.splits = list(compress(self.graph.splits, keep_mask))
+        split_graph.node_ids = list(compress(self.graph.node_ids, keep_mask))
 
         assert len(split_graph.splits) == split_graph.x.shape[0], "Splits not subset"
         assert (
             len(split_graph.node_ids) == split_graph.x.shape[0]
         ), "Node_ids not subset"
 
-        prev_label_counts = [0 for _ in range(len(self.labels))]
-
-        for doc_node_id in self.split2nodeids[self.split]:
-            prev_label_counts[self.nodeid2label[doc_node_id].item()] += 1
-
-        cur_label_counts = torch.bincount(split_graph.y[split_graph.mask]).tolist()
+        # The mask marks exactly the labelled docs of the current split
+        prev_label_counts = torch.bincount(
+            self.graph.y[self.graph.mask], minlength=len(self.labels)
+        ).tolist()
+        cur_label_counts = torch.bincount(
+            split_graph.y[split_graph.mask], minlength=len(self.labels)
+        ).tolist()
 
         self.log("\nUpdated label count:")
         for label, clss in sorted(self.labels.items(), key=lambda x: x[0]):
@@ -267,8 +255,8 @@ class SocialGraph(PostProcessing):
                 + f"[{(cur_label_counts[label] / prev_label_counts[label]) * 100:.2f}%]"
             )
 
-        prev_num_users = sum(1 for split in self.graph.splits if split == "user")
-        cur_num_users = sum(1 for split in split_graph.splits if split == "user")
+        prev_num_users = int(np.sum(is_user))
+        cur_num_users = int(np.sum(is_user & keep_mask))
         self.log(
             f"\nUsers kept {cur_num_users}/{prev_num_users} [{(cur_num_users / prev_num_users) * 100:.2f}%]"
         )
@@ -280,6 +268,22 @@ class SocialGraph(PostProcessing):
         hours, minutes, seconds = calc_elapsed_time(start_time, end_time)
         self.log(f"Time taken: {hours:02d}:{minutes:02d}:{seconds:02d}")
 
+    def _connected_components(self, nodes_to_keep):
+        # Restrict the adjacency to the kept nodes, without building a subgraph
+        adj = to_scipy_sparse_matrix(
+            self.graph.edge_index, num_nodes=self.graph.num_nodes
+        ).tocsr()
+
+        nodes_to_keep = nodes_to_keep.numpy()
+        adj = adj[nodes_to_keep][:, nodes_to_keep]
+
+        num_components, component = sp.csgraph.connected_components(
+            adj,
+            connection="weak",
+        )
+
+        return num_components, torch.from_numpy(component)
+
     def __repr__(self):
         return f"SocialGraph(mode={self.structure_mode}, split={self.split}, keep_cc={self.keep_cc})"
 
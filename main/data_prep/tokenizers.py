@@ -4,31 +4,48 @@ import pickle
 from string import punctuation
 from collections import Counter
 
+import numpy as np
 import nltk
 from nltk.tokenize import word_tokenize
 from transformers import AutoConfig, AutoTokenizer
+from datasets.fingerprint import Hasher
 
 from utils.io import load_json_file
 
 
+# Patterns are compiled once, instead of on every call
+WHITESPACE_PATTERN = re.compile("\\s+")
+NUMBER_PATTERN = re.compile("\\b[0-9]+\\b")
+HASHTAG_PATTERN = re.compile(r"#[\w-]+")
+MENTION_PATTERN = re.compile(r"@[\w-]+")
+URL_PATTERN = re.compile(r"https?://\S+")
+# Matches the earlier `[...]` regex class, where `\]` escaped the bracket
+# instead of adding a backslash, so backslashes are kept
+PUNCTUATION_CHARS = punctuation.replace("\\", "")
+PUNCTUATION_TABLE = str.maketrans(PUNCTUATION_CHARS, " " * len(PUNCTUATION_CHARS))
+
+# Part of the tokenizer fingerprints, bump whenever tokenization changes
+TOKENIZER_VERSION = 2
+
+
 def sanitize_text(
     text, remove_punctuation: bool = False, replace_with_string: bool = False
 ):
-    text = re.sub("\\s+", " ", text)
+    text = WHITESPACE_PATTERN.sub(" ", text)
 
     # (twitter hate speech) preprocessing
-    text = re.sub("\\b[0-9]+\\b", "", text)
+    text = NUMBER_PATTERN.sub("", text)
 
     # (gossipcop) preprocessing from safer paper
     text = text.replace("\n", " ")
     text = text.replace("\t", " ")
-    text = re.sub(r"#[\w-]+", "hashtag" if replace_with_string else " ", text)
-    text = re.sub(r"@[\w-]+", "user" if replace_with_string else " ", text)
-    text = re.sub(r"https?://\S+", "URL" if replace_with_string else " ", text)
+    text = HASHTAG_PATTERN.sub("hashtag" if replace_with_string else " ", text)
+    text = MENTION_PATTERN.sub("user" if replace_with_string else " ", text)
+    text = URL_PATTERN.sub("URL" if replace_with_string else " ", text)
 
     if remove_punctuation:
         text = text.encode("ascii", errors="ignore").strip().decode("ascii")
-        text = re.sub("[" + punctuation + "]", " ", text)
+        text = text.translate(PUNCTUATION_TABLE)
 
     return text
 
@@ -48,7 +65,7 @@ class OneHotTokenizer(object):
         self.stop_words_fp = stop_words_fp
         if self.stop_words_fp is not None:
             with open(self.stop_words_fp, "r") as f:
-                self.stop_words = f.read().split()
+                self.stop_words = frozenset(f.read().split())
         else:
             print("\n>>>WARNING: KEEPING STOP WORDS<<<\n")
 
@@ -74,9 +91,10 @@ class OneHotTokenizer(object):
         return text
 
     def build_vocab(self, all_texts):
-        all_texts = list(map(self.preprocess_string, all_texts))
-
-        word_freq = Counter(token for doc in all_texts for token in doc)
+        # Streams over the documents, never holds all tokenized texts at once
+        word_freq = Counter()
+        for tokens in map(self.preprocess_string, all_texts):
+            word_freq.update(tokens)
 
         self.vocab = {
             word: i
@@ -106,6 +124,73 @@ class OneHotTokenizer(object):
             "length": len(indices),
         }
 
+    def _encode_batch(self, texts):
+        # Flatten all tokens in the batch, with the document they came from
+        doc_tokens = list(map(self.preprocess_string, texts))
+
+        doc_lengths = np.fromiter(map(len, doc_tokens), dtype=np.int64)
+        doc_idx = np.repeat(np.arange(len(doc_tokens)), doc_lengths)
+
+        tokens = [token for doc in doc_tokens for token in doc]
+
+        # Vocab lookup on the unique tokens only
+        unique_tokens, inverse = np.unique(
+            np.asarray(tokens, dtype=object).astype(str), return_inverse=True
+        )
+        unique_ids = np.fromiter(
+            (self.stoi(token) for token in unique_tokens),
+            dtype=np.int64,
+            count=len(unique_tokens),
+        )
+        token_ids = unique_ids[inverse.reshape(-1)]
+
+        is_oov = token_ids == self.oov_idx
+        oov_counts = np.bincount(doc_idx[is_oov], minlength=len(texts))
+
+        # Each document is a set of its in-vocab tokens, sorted by token id
+        # Token ids need not be contiguous, so key on the largest id instead
+        num_ids = max(self.vocab.values(), default=0) + 1
+
+        doc_token_keys = np.unique(doc_idx[~is_oov] * num_ids + token_ids[~is_oov])
+        indices = doc_token_keys % num_ids
+        lengths = np.bincount(doc_token_keys // num_ids, minlength=len(texts))
+
+        offsets = np.cumsum(lengths) - lengths
+
+        return indices, offsets, lengths, oov_counts
+
+    def encode_batch(self, texts):
+        """
+        Tokenizes a batch of texts into the present vocab tokens of each text.
+        Returns CSR-style `(indices, offsets)` arrays, where `offsets` holds the
+        start of each text in `indices`, as expected by `nn.EmbeddingBag`.
+
+        """
+        indices, offsets, _, _ = self._encode_batch(texts)
+
+        return indices, offsets
+
+    def tokenize_batch(self, texts):
+        indices, offsets, lengths, oov_counts = self._encode_batch(texts)
+
+        return {
+            "input_ids": [
+                indices[start : start + length].tolist()
+                for start, length in zip(offsets, lengths)
+            ],
+            "oov_count": oov_counts.tolist(),
+            "length": lengths.tolist(),
+        }
+
+    @property
+    def fingerprint(self):
+        # Sorted, as the hash of a set is not stable across processes
+        stop_words = getattr(self, "stop_words", None)
+        if stop_words is not None:
+            stop_words = sorted(stop_words)
+
+        return Hasher.hash((TOKENIZER_VERSION, self.vocab, stop_words, self.oov_idx))
+
     def save(self, fp):
         state_dict = {
             "vocab_size": self.vocab_size,
@@ -160,6 +245,24 @@ class LMTokenizer(object):
             **self.tokenizer_kwargs,
         )
 
+    def tokenize_batch(self, texts):
+        # Uses the fast tokenizer's batch mode
+        sanitized_texts = [
+            sanitize_text(text, replace_with_string=True) for text in texts
+        ]
+
+        return self.tokenizer(
+            sanitized_texts,
+            max_length=self.config.max_position_embeddings - 2,
+            **self.tokenizer_kwargs,
+        )
+
+    @property
+    def fingerprint(self):
+        return Hasher.hash(
+            (TOKENIZER_VERSION, self.lm_name, self.tokenizer_kwargs, self.tokenizer)
+        )
+
     def save(self, fp):
         state_dict = {
             "lm_name": self.lm_name,
@@ -13,6 +13,7 @@ from lightning_lite.utilities.seed import seed_everything
 
 from data_loading.get_loader import get_dataloader
 from models import GatNonEpisodic, GatMAML, GatPrototypical
+from models.utils import run_validation
 from utils.logging import get_results_dir
 
 if torch.cuda.is_available():
@@ -292,7 +293,7 @@ def evaluate(args):
         model.val_prefix = "train"
         model.test_prefix = "train"
 
-        train_results = trainer.validate(model, train_loader, verbose=False)[0]
+        train_results = run_validation(args, trainer, model, train_loader)
         dump_results(
             args,
             prefix=model.test_prefix,
@@ -319,7 +320,7 @@ def evaluate(args):
             )
 
         else:
-            val_results = trainer.validate(model, val_loader, verbose=False)[0]
+            val_results = run_validation(args, trainer, model, val_loader)
             dump_results(
                 args,
                 prefix=model.test_prefix,
@@ -346,7 +347,7 @@ def evaluate(args):
             )
 
         else:
-            test_results = trainer.validate(model, test_loader, verbose=False)[0]
+            test_results = run_validation(args, trainer, model, test_loader)
             dump_results(
                 args,
                 prefix=model.test_prefix,
@@ -4,13 +4,44 @@ from collections import defaultdict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.multiprocessing as mp
 from torch.optim import AdamW, SGD
 from torch.optim.lr_scheduler import StepLR
 import pytorch_lightning as pl
 
 from models.utils import WarmupCosineSchedule
+from utils.graph_functions import receptive_field
 from utils.metrics import compute_clf_metrics, compute_aupr_metrics
 
+# Per-process state of the episodic evaluation workers
+# Populated once by the pool initializer, so that the model and the full query
+# graph are not re-sent with every episode
+_eval_worker_state = dict()
+
+
+def _init_episodic_eval_worker(meta_learner, dataset, prefix):
+    # Each worker evaluates a single episode at a time
+    # Avoids oversubscribing the cores with intra-op threads
+    torch.set_num_threads(1)
+
+    _eval_worker_state["meta_learner"] = meta_learner
+    _eval_worker_state["dataset"] = dataset
+    _eval_worker_state["prefix"] = prefix
+
+
+def _episodic_eval_worker(support_batch):
+    meta_learner = _eval_worker_state["meta_learner"]
+    dataset = _eval_worker_state["dataset"]
+
+    graphs = dataset.collate_fn_eval([(support_batch, None)])
+
+    step_metrics, _, _ = meta_learner.eval_step(
+        graphs, prefix=_eval_worker_state["prefix"]
+    )
+
+    # Only the (small) metric dict travels back to the main process
+    return {k: float(v) for k, v in step_metrics.items()}
+
 
 class BaseMetaLearner(pl.LightningModule):
     def __init__(
@@ -43,6 +74,14 @@ class BaseMetaLearner(pl.LightningModule):
         )
         self.eval_reset_classifier = None
 
+        # Number of thresholds for the binned PR curves, exact curves if None
+        self.pr_bins = evaluation_params.get("pr_bins", None)
+
+        # Labelled query nodes' receptive field, reused across episodes
+        # Their features are also reused if the backbone is frozen
+        self._frozen_query_features = None
+        self._query_receptive_field = None
+
         # Misc =================================================================
         # Which index value to ignore when computing loss
         # Should default to -1
@@ -121,7 +160,7 @@ class BaseMetaLearner(pl.LightningModule):
 
         return total_norm
 
-    def metrics(self, logits, gt, prefix: str = ""):
+    def metrics(self, logits, gt, prefix: str = "", pr_metrics: bool = True):
         preds = torch.argmax(logits, dim=-1)
         probs = F.softmax(logits, dim=-1)
 
@@ -133,13 +172,16 @@ class BaseMetaLearner(pl.LightningModule):
             ignore_index=self.ignore_index,
         )
 
-        metrics |= compute_aupr_metrics(
-            probs,
-            gt,
-            prefix=prefix,
-            num_classes=self.n_classes,
-            ignore_index=self.ignore_index,
-        )
+        # Can be skipped if computed for many episodes at once
+        if pr_metrics:
+            metrics |= compute_aupr_metrics(
+                probs,
+                gt,
+                prefix=prefix,
+                num_classes=self.n_classes,
+                ignore_index=self.ignore_index,
+                num_bins=self.pr_bins,
+            )
 
         return metrics, preds, gt
 
@@ -153,6 +195,76 @@ class BaseMetaLearner(pl.LightningModule):
     def _logits_to_preds(self, logits):
         return torch.argmax(logits, dim=1)
 
+    @property
+    def frozen_backbone_adaptation(self):
+        # If the feature extractor never receives an update during adaptation
+        # only the classification head differs between episodes
+        return self.eval_n_inner_updates == 0 or self.eval_lr_inner == 0
+
+    def query_receptive_field(self, query_graph):
+        # Only labelled query nodes contribute to the loss and metrics
+        # Their receptive field is gathered once and reused across episodes
+        query_nodes = torch.where(
+            (query_graph.y != self.ignore_index) | query_graph.mask.bool()
+        )[0]
+
+        field = self._query_receptive_field
+
+        if (
+            field is not None
+            and field["num_nodes"] == query_graph.num_nodes
+            and torch.all(torch.isin(query_nodes, field["node_idx"]))
+        ):
+            return field
+
+        # Labelled support nodes differ between episodes
+        # Grow the field to cover all labelled nodes seen so far
+        if field is not None and field["num_nodes"] == query_graph.num_nodes:
+            query_nodes = torch.unique(torch.cat([field["node_idx"], query_nodes]))
+
+        subset, edge_index, mapping = receptive_field(
+            query_nodes,
+            query_graph.edge_index,
+            num_nodes=query_graph.num_nodes,
+            num_hops=self.model.num_hops,
+        )
+
+        self._query_receptive_field = {
+            "num_nodes": query_graph.num_nodes,
+            "node_idx": query_nodes,
+            "subset": subset,
+            "edge_index": edge_index,
+            "mapping": mapping,
+        }
+
+        # Any cached features belong to the old field
+        self._frozen_query_features = None
+
+        return self._query_receptive_field
+
+    def query_features(self, task_model, query_graph):
+        """
+        Features of the labelled query nodes, computed on their receptive field only.
+        Returns the location of the labelled nodes in the query graph, and their features.
+
+        """
+        field = self.query_receptive_field(query_graph)
+
+        # If only the head is adapted, the features are the same for every episode
+        # They only need to be computed once per evaluation run
+        if self.frozen_backbone_adaptation and self._frozen_query_features is not None:
+            return field["node_idx"], self._frozen_query_features
+
+        features = task_model.extract_features(
+            query_graph.x[field["subset"]], field["edge_index"]
+        )
+        features = features[field["mapping"]]
+
+        if self.frozen_backbone_adaptation:
+            self._frozen_query_features = features
+
+        return field["node_idx"], features
+
     def clone(self, reset_classifier: bool = False, output_dim: int = None):
         # Need to be defined by the model classes inhereting this class
         raise NotImplementedError()
@@ -313,11 +425,16 @@ class BaseMetaLearner(pl.LightningModule):
             # Evaluate the adapted model on all available data =================
             # Query graph should contain nodes in support graph
             # But it's nodes are not labelled, and not counted towards metrics
-            q_logits = self.forward(task_model, query_graph, "eval")
+            # Only the labelled nodes' receptive field needs to be propagated over
+            node_idx, q_features = self.query_features(task_model, query_graph)
+            q_logits = task_model.classifier(q_features)
+
+            q_y = query_graph.y[node_idx]
+            q_mask = query_graph.mask[node_idx]
 
             loss = F.cross_entropy(
                 q_logits,
-                query_graph.y,
+                q_y,
                 ignore_index=self.ignore_index,
                 weight=self.eval_class_weights,
             )
@@ -325,15 +442,15 @@ class BaseMetaLearner(pl.LightningModule):
 
             loss = F.cross_entropy(
                 q_logits,
-                query_graph.y,
+                q_y,
                 ignore_index=self.ignore_index,
                 weight=None,
             )
             query_post_adapt_unweighted_loss.append(loss.cpu())
 
             # Get preds on center nodes only
-            preds_gt["logits"].append(q_logits.detach()[query_graph.mask].cpu())
-            preds_gt["gt"].append(query_graph.y[query_graph.mask].cpu())
+            preds_gt["logits"].append(q_logits.detach()[q_mask].cpu())
+            preds_gt["gt"].append(q_y[q_mask].cpu())
 
         # Stats aggregation ====================================================
         # Want the task_model off memory ASAP
@@ -387,6 +504,8 @@ class BaseMetaLearner(pl.LightningModule):
 
     def on_validation_epoch_start(self) -> None:
         self.validation_epoch_metrics = defaultdict(list)
+        self._frozen_query_features = None
+        self._query_receptive_field = None
 
         return super().on_validation_epoch_start()
 
@@ -396,40 +515,102 @@ class BaseMetaLearner(pl.LightningModule):
         for k, v in step_metrics.items():
             self.validation_epoch_metrics[k] += [v]
 
-    def on_validation_epoch_end(self) -> None:
-        super().on_validation_epoch_end()
-
-        assert all(
-            map(lambda x: len(x) > 0, list(self.validation_epoch_metrics.values()))
-        ), "Empty validation epoch values."
-
-        for k, v in self.validation_epoch_metrics.items():
+    @staticmethod
+    def summarize_epoch_metrics(epoch_metrics):
+        summary = dict()
+        for k, v in epoch_metrics.items():
             v_tensor = torch.stack(v)
 
             mean = torch.mean(v_tensor)
             std = torch.std(v_tensor)
 
-            self.log_dict(
+            summary.update(
                 {
                     k: mean,
                     k + "_std": std,
                     k + "_se": std / math.sqrt(v_tensor.shape[0]),
-                },
-                on_step=False,
-                on_epoch=True,
+                }
             )
 
+        return summary, v_tensor.shape[0]
+
+    def on_validation_epoch_end(self) -> None:
+        super().on_validation_epoch_end()
+
+        assert all(
+            map(lambda x: len(x) > 0, list(self.validation_epoch_metrics.values()))
+        ), "Empty validation epoch values."
+
+        summary, eval_iterations = self.summarize_epoch_metrics(
+            self.validation_epoch_metrics
+        )
+
+        self.log_dict(
+            summary,
+            on_step=False,
+            on_epoch=True,
+        )
+
         self.log(
             f"{self.val_prefix}/eval_iterations",
-            float(v_tensor.shape[0]),
+            float(eval_iterations),
             on_step=False,
             on_epoch=True,
         )
 
+    def parallel_episodic_eval(self, dataset, num_workers: int):
+        """
+        Evaluates all episodes of an episodic dataset using a pool of CPU workers.
+        Mimics `trainer.validate`, but fans the (independent) episodes out over
+        processes. Each worker holds a shared-memory copy of the meta-parameters
+        and the full query graph, only the per-episode metrics get sent back.
+
+        """
+        if torch.cuda.is_available():
+            raise ValueError("Parallel episodic evaluation is CPU only.")
+
+        prefix = f"{self.val_prefix}/"
+
+        self.model.eval()
+        self._frozen_query_features = None
+        self._query_receptive_field = None
+
+        # Put the fold-wide tensors in shared memory before forking
+        # Workers then read these without copying
+        self.share_memory()
+        dataset.graph.share_memory_()
+
+        epoch_metrics = defaultdict(list)
+        with mp.Pool(
+            processes=num_workers,
+            initializer=_init_episodic_eval_worker,
+            initargs=(self, dataset, prefix),
+        ) as pool:
+            support_batches = (support_batch for support_batch, _ in dataset)
+
+            for step_metrics in pool.imap(_episodic_eval_worker, support_batches):
+                for k, v in step_metrics.items():
+                    epoch_metrics[k] += [torch.tensor(v)]
+
+        return self.epoch_metrics_to_results(epoch_metrics)
+
+    def epoch_metrics_to_results(self, epoch_metrics):
+        # Same output format as `trainer.validate`
+        assert len(epoch_metrics) > 0, "Empty validation epoch values."
+
+        summary, eval_iterations = self.summarize_epoch_metrics(epoch_metrics)
+
+        results = {k: v.item() for k, v in summary.items()}
+        results[f"{self.val_prefix}/eval_iterations"] = float(eval_iterations)
+
+        return results
+
     def on_test_epoch_start(self) -> None:
         self.test_epoch_metrics = defaultdict(list)
         self.test_epoch_preds = list()
         self.test_epoch_gt = list()
+        self._frozen_query_features = None
+        self._query_receptive_field = None
 
         return super().on_test_epoch_start()
 
@@ -3,9 +3,55 @@ from collections import OrderedDict
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from transformers import AutoConfig, AutoTokenizer, AutoModel
 
 
+class SparseLinear(nn.Module):
+    """
+    A linear layer applied to bags of token ids, equivalent to `nn.Linear` on
+    the dense one-hot matrix. The weight is stored as `in_features x
+    out_features`, so present rows are gathered without any copies.
+
+    """
+
+    def __init__(self, in_features: int, out_features: int):
+        super().__init__()
+
+        self.in_features = in_features
+        self.out_features = out_features
+
+        self.weight = nn.Parameter(torch.empty((in_features, out_features)))
+        self.bias = nn.Parameter(torch.empty((out_features,)))
+
+    def forward(self, indices, offsets, per_sample_weights=None):
+        out = F.embedding_bag(
+            indices,
+            self.weight,
+            offsets,
+            mode="sum",
+            per_sample_weights=per_sample_weights,
+        )
+
+        return out + self.bias
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older feature extractors stored the `nn.Linear` layout
+        weight = state_dict.get(prefix + "weight")
+        if (
+            weight is not None
+            and weight.shape
+            == (
+                self.out_features,
+                self.in_features,
+            )
+            and weight.shape != self.weight.shape
+        ):
+            state_dict[prefix + "weight"] = weight.t().contiguous()
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
 class FeatureExtractor(nn.Module):
     def __init__(
         self,
@@ -32,7 +78,7 @@ class FeatureExtractor(nn.Module):
                 # If learning or using random projection
                 # Projection method is a linear layer
                 self.compressed_size = compressed_size
-                self.compressor = nn.Linear(
+                self.compressor = SparseLinear(
                     in_features=self.vocab_size,
                     out_features=self.compressed_size,
                 )
@@ -105,32 +151,68 @@ class FeatureExtractor(nn.Module):
         std = gain / math.sqrt(self.compressor.in_features)
         bound = math.sqrt(3.0) * std
 
+        # Sampled in the `nn.Linear` layout, so projections stay the same
         rng = torch.Generator().manual_seed(0)
         with torch.no_grad():
-            self.compressor.weight.uniform_(-bound, bound, generator=rng)
+            weight = torch.empty(
+                (self.compressor.out_features, self.compressor.in_features)
+            )
+            weight.uniform_(-bound, bound, generator=rng)
+
+            self.compressor.weight.copy_(weight.t())
             self.compressor.bias.zero_()
 
     @property
     def device(self):
         return next(self.parameters()).device
 
+    def sparse_compress(self, indices, offsets, per_sample_weights=None):
+        if isinstance(self.compressor, SparseLinear):
+            # Scales with the number of present tokens, not the vocab size
+            return self.compressor(indices, offsets, per_sample_weights)
+
+        else:
+            # Without compression, the dense one-hot matrix is the feature vector
+            if per_sample_weights is None:
+                per_sample_weights = torch.ones_like(indices, dtype=torch.float)
+
+            rows = torch.repeat_interleave(
+                torch.arange(offsets.shape[0], device=indices.device),
+                torch.diff(offsets, append=offsets.new_tensor([indices.shape[0]])),
+            )
+
+            out = torch.zeros(
+                (offsets.shape[0], self.vocab_size), device=indices.device
+            )
+            out[rows, indices] = per_sample_weights
+
+            return self.compressor(out)
+
     def compress(self, x):
         if self.feature_type == "one-hot":
+            # Inputs are the present tokens in CSR format
+            # Masking a token just drops it from the bag
+            per_sample_weights = None
             if self.training:
-                mask = torch.rand(x["model_input"].shape) < self.p_mask_token
-
-                x["model_input"] = torch.where(
-                    mask.to(self.device),
-                    0.0,
-                    x["model_input"],
-                )
+                per_sample_weights = (
+                    torch.rand(x["indices"].shape, device=self.device)
+                    >= self.p_mask_token
+                ).float()
 
             if self.compression == "random":
                 with torch.inference_mode():
-                    out = self.compressor(x["model_input"])
+                    out = self.sparse_compress(
+                        x["indices"], x["offsets"], per_sample_weights
+                    )
 
             else:
-                out = self.compressor(x["model_input"])
+                out = self.sparse_compress(
+                    x["indices"], x["offsets"], per_sample_weights
+                )
+
+        elif self.feature_type == "lm-embeddings" and "embeddings" in x:
+            # Pre-computed embeddings from the frozen LM
+            out = x["embeddings"].float()
 
         elif self.feature_type == "lm-embeddings":
             if self.training:
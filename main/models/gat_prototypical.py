@@ -1,3 +1,4 @@
+from collections import defaultdict
 from copy import deepcopy
 
 import torch
@@ -8,6 +9,7 @@ from torch.optim import SGD
 from models.base_meta_learner import BaseMetaLearner
 from models.sparse_gat import SparseGatNet
 from models.pointwise_baseline import PointwiseMLP
+from utils.metrics import compute_batched_aupr_metrics
 
 
 class GatPrototypical(BaseMetaLearner):
@@ -41,6 +43,43 @@ class GatPrototypical(BaseMetaLearner):
 
         return task_model
 
+    @property
+    def _eval_n_inner_updates(self):
+        # Falls back onto the training hyperparameters if not set for evaluation
+        if self.eval_n_inner_updates is None:
+            return self.n_inner_updates
+        else:
+            return self.eval_n_inner_updates
+
+    @property
+    def frozen_backbone_adaptation(self):
+        if self.eval_lr_inner is None:
+            lr = self.lr_inner
+        else:
+            lr = self.eval_lr_inner
+
+        return self._eval_n_inner_updates == 0 or lr == 0
+
+    @property
+    def prototypes_only_eval(self):
+        # Without inner loop updates, ProtoMAML reduces to a ProtoNet
+        return self._eval_n_inner_updates == 0
+
+    def compute_prototypes(self, features, y):
+        prototypes = torch.stack(
+            [torch.mean(features[y == l], dim=(0,)) for l in range(self.n_classes)]
+        )
+
+        return prototypes
+
+    @staticmethod
+    def prototypes_to_linear(prototypes):
+        # Squared euclidean distance, up to a constant per query node
+        weight = 2 * prototypes
+        bias = -torch.pow(torch.norm(prototypes, dim=-1), 2)
+
+        return weight, bias
+
     def adapt(
         self,
         model,
@@ -74,16 +113,10 @@ class GatPrototypical(BaseMetaLearner):
             extracted_features = self.model.extract_features(graph.x, graph.edge_index)
 
             # Compute prototypes
-            prototypes = torch.stack(
-                [
-                    torch.mean(extracted_features[graph.y == l], dim=(0,))
-                    for l in range(self.n_classes)
-                ]
-            )
+            prototypes = self.compute_prototypes(extracted_features, graph.y)
 
             # Convert prototypes to linear layer parameters
-            init_weight = 2 * prototypes
-            init_bias = -torch.pow(torch.norm(prototypes, dim=1), 2)
+            init_weight, init_bias = self.prototypes_to_linear(prototypes)
 
         # Copy prototype weights to model classification head
         # Detach protopypes from computation graph
@@ -274,4 +307,206 @@ class GatPrototypical(BaseMetaLearner):
         return q_loss
 
     def eval_step(self, *args, **kwargs):
-        return self.episodic_eval_step(*args, **kwargs)
+        if self.prototypes_only_eval:
+            return self.prototypical_eval_step(*args, **kwargs)
+
+        else:
+            return self.episodic_eval_step(*args, **kwargs)
+
+    def _prototypical_step_metrics(
+        self, s_logits, s_y, q_logits, q_y, q_mask, prefix, pr_metrics: bool = True
+    ):
+        # Mirrors the logs of `episodic_eval_step`
+        # Without updates, the pre- and post-adaptation support losses are equal
+        s_loss = (
+            F.cross_entropy(
+                s_logits,
+                s_y,
+                ignore_index=self.ignore_index,
+                weight=self.eval_class_weights,
+            )
+            .detach()
+            .cpu()
+        )
+
+        step_metrics = {
+            prefix + "supp_pre_loss": s_loss,
+            prefix + "supp_mean_loss": s_loss,
+            prefix + "supp_post_loss": s_loss,
+            prefix + "supp_improvement": torch.zeros_like(s_loss),
+        }
+
+        q_loss = F.cross_entropy(
+            q_logits,
+            q_y,
+            ignore_index=self.ignore_index,
+            weight=self.eval_class_weights,
+        )
+
+        q_loss_unweighted = F.cross_entropy(
+            q_logits,
+            q_y,
+            ignore_index=self.ignore_index,
+            weight=None,
+        )
+
+        metrics, preds, gt = self.metrics(
+            logits=q_logits.detach()[q_mask].cpu(),
+            gt=q_y[q_mask].cpu(),
+            prefix=prefix,
+            pr_metrics=pr_metrics,
+        )
+        step_metrics.update(metrics)
+
+        step_metrics.update(
+            {
+                prefix + "query_mean_loss": q_loss.cpu(),
+                prefix + "query_mean_loss_unweighted": q_loss_unweighted.cpu(),
+            }
+        )
+
+        return step_metrics, preds, gt
+
+    def prototypical_eval_step(self, graphs, prefix: str = ""):
+        """
+        Evaluation on a single episode, without any inner loop updates.
+        Equivalent to `episodic_eval_step`, but skips cloning the model and reuses
+        the query features across episodes.
+
+        """
+        support_graph, query_graph = graphs
+
+        self.model.eval()
+
+        with torch.no_grad():
+            s_features = self.model.extract_features(
+                support_graph.x, support_graph.edge_index
+            )
+
+            prototypes = self.compute_prototypes(s_features, support_graph.y)
+            weight, bias = self.prototypes_to_linear(prototypes)
+
+            s_logits = F.linear(s_features, weight=weight, bias=bias)
+
+            node_idx, q_features = self.query_features(self.model, query_graph)
+            q_logits = F.linear(q_features, weight=weight, bias=bias)
+
+        return self._prototypical_step_metrics(
+            s_logits,
+            support_graph.y,
+            q_logits,
+            query_graph.y[node_idx],
+            query_graph.mask[node_idx].bool(),
+            prefix=prefix,
+        )
+
+    def batched_prototypical_eval(self, dataset):
+        """
+        ProtoNet evaluation of all episodes in an episodic dataset at once.
+            1. Embeds the labelled query nodes once, using their receptive field only
+            2. Computes the prototypes of each episode from its support graph
+            3. Scores all labelled query nodes against all prototypes in one
+               batched distance computation
+
+        Returns the same output as `trainer.validate`.
+
+        """
+        prefix = f"{self.val_prefix}/"
+
+        self.model.eval()
+
+        graph = dataset.graph
+
+        with torch.no_grad():
+            # Embed the query graph ============================================
+            # Only labelled nodes can ever contribute to the query metrics
+            labelled_nodes = torch.where(graph.mask.bool())[0]
+
+            q_features = self.model.extract_node_features(
+                graph.x.to(self.device),
+                graph.edge_index.to(self.device),
+                labelled_nodes.to(self.device),
+            )
+            q_y = graph.y[labelled_nodes].to(self.device)
+            q_idx = graph.idx[labelled_nodes]
+
+            # Compute the prototypes for each episode ==========================
+            prototypes = []
+            support_logs = []
+            q_masks = []
+            for support_batch, _ in dataset:
+                support_graph = dataset.support_graph_dataset.collate_fn(
+                    [support_batch]
+                )
+
+                s_features = self.model.extract_features(
+                    support_graph.x.to(self.device),
+                    support_graph.edge_index.to(self.device),
+                )
+                s_y = support_graph.y.to(self.device)
+
+                episode_prototypes = self.compute_prototypes(s_features, s_y)
+
+                s_logits = F.linear(
+                    s_features, *self.prototypes_to_linear(episode_prototypes)
+                )
+
+                prototypes.append(episode_prototypes)
+                support_logs.append((s_logits, s_y))
+
+                # The labelled support nodes do not count towards the query metrics
+                q_masks.append(
+                    ~torch.isin(
+                        q_idx, support_batch["graph_idx"][support_graph.mask.bool()]
+                    )
+                )
+
+            # Score all query nodes for all episodes ===========================
+            # episodes x classes x dim
+            prototypes = torch.stack(prototypes, dim=0)
+            weight, bias = self.prototypes_to_linear(prototypes)
+
+            # episodes x query nodes x classes
+            q_logits = torch.matmul(q_features, weight.transpose(1, 2))
+            q_logits = q_logits + bias.unsqueeze(1)
+
+        # Per episode metrics ==================================================
+        # Exact PR curves of all episodes are computed together afterwards
+        # Binned PR curves are computed per episode, as in `episodic_eval_step`
+        batched_pr_metrics = self.pr_bins is None
+
+        epoch_metrics = defaultdict(list)
+        for (s_logits, s_y), episode_q_logits, q_mask in zip(
+            support_logs, q_logits, q_masks
+        ):
+            q_mask = q_mask.to(self.device)
+
+            step_metrics, _, _ = self._prototypical_step_metrics(
+                s_logits,
+                s_y,
+                episode_q_logits,
+                q_y.masked_fill(~q_mask, self.ignore_index),
+                q_mask,
+                prefix=prefix,
+                pr_metrics=not batched_pr_metrics,
+            )
+
+            for k, v in step_metrics.items():
+                epoch_metrics[k] += [v]
+
+        if batched_pr_metrics:
+            # The PR curves of all episodes share a single sort per class
+            pr_analysis = compute_batched_aupr_metrics(
+                F.softmax(q_logits, dim=-1).cpu(),
+                q_y.masked_fill(
+                    ~torch.stack(q_masks).to(self.device), self.ignore_index
+                ).cpu(),
+                num_classes=self.n_classes,
+                prefix=prefix,
+                ignore_index=self.ignore_index,
+            )
+
+            for k, v in pr_analysis.items():
+                epoch_metrics[k] += list(v.unbind())
+
+        return self.epoch_metrics_to_results(epoch_metrics)
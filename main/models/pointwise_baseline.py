@@ -11,6 +11,9 @@ class PointwiseMLP(nn.Module):
 
     """
 
+    # Nodes are embedded independently of their neighbours
+    num_hops = 0
+
     def __init__(self, model_params):
         super(PointwiseMLP, self).__init__()
 
@@ -78,6 +81,9 @@ class PointwiseMLP(nn.Module):
 
         return x
 
+    def extract_node_features(self, x, edge_index, node_idx):
+        return self.extract_features(x[node_idx], edge_index)
+
     def forward(self, x, edge_index, mode=None):
         #! Deprecated argument: mode
         # Mode left here for legacy purposes, no longer serves a purpose
@@ -3,8 +3,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from utils.graph_functions import receptive_field
+
 
 class SparseGatNet(nn.Module):
+    # Two attention layers deep, so a node's output depends on its 2-hop neighbours
+    num_hops = 2
+
     def __init__(self, model_params):
         super(SparseGatNet, self).__init__()
 
@@ -98,6 +103,16 @@ class SparseGatNet(nn.Module):
 
         return x
 
+    def extract_node_features(self, x, edge_index, node_idx):
+        # Only propagates over the receptive field of the requested nodes
+        subset, sub_edge_index, mapping = receptive_field(
+            node_idx, edge_index, num_nodes=x.shape[0], num_hops=self.num_hops
+        )
+
+        x = self.extract_features(x[subset], sub_edge_index)
+
+        return x[mapping]
+
     def forward(self, x, edge_index, mode=None):
         #! Deprecated argument: mode
         # Mode left here for legacy purposes, no longer serves a purpose
@@ -177,7 +192,8 @@ class SparseGATLayer(nn.Module):
 
         # Compute and pass weighted messages ===================================
         # num_nodes x out_features
-        score = torch.sparse_coo_tensor(edges, score)
+        # Explicit size, nodes without edges might be present (e.g. receptive fields)
+        score = torch.sparse_coo_tensor(edges, score, size=(x.shape[0], x.shape[0]))
 
         # num_nodes x out_features
         seq = torch.transpose(seq.squeeze(0), 0, 1)
@@ -22,3 +22,28 @@ class WarmupCosineSchedule(LambdaLR):
         # progress after warmup
         progress = float(step - self.warmup_steps) / float(max(1, self.t_total - self.warmup_steps))
         return max(0.0, 0.5 * (1. + math.cos(math.pi * float(self.cycles) * 2.0 * progress)))
+
+
+def run_validation(args, trainer, model, loader):
+    """
+    Evaluates a model on a single split, using the fastest evaluation path
+    the model and structure support.
+
+    """
+    if args["structure"]["structure"] in {"episodic_khop", "episodic_doc_only_khop"}:
+        # Pure ProtoNet evaluation scores all episodes in a single batched pass
+        if getattr(model, "prototypes_only_eval", False):
+            print("Evaluating all episodes with batched prototypes.")
+
+            return model.batched_prototypical_eval(loader.dataset)
+
+        # Otherwise, episodes can be spread over a pool of CPU workers
+        if args.get("eval_num_workers", 0) > 0 and not torch.cuda.is_available():
+            print(f"Evaluating episodes using {args['eval_num_workers']} workers.")
+
+            return model.parallel_episodic_eval(
+                loader.dataset, num_workers=args["eval_num_workers"]
+            )
+
+    # Default to the Lightning validation loop
+    return trainer.validate(model, loader, verbose=False)[0]
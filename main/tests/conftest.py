@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules are imported relative to `main`, as in the entry point scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
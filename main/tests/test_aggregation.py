@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import torch
+
+from data_loading.batched_user_neighbourhood import BatchedKHopUserNeighbourhood
+
+LABELS = {0: "real", 1: "fake"}
+
+SUBGRAPHS = [
+    {
+        "partition_id": 1,
+        "central_nodes": torch.tensor([0]),
+        "graph_idx": torch.tensor([5, 6]),
+        "edge_index": torch.tensor([[0], [1]]),
+        "num_nodes": 2,
+        "num_edges": 1,
+        "label_info": {
+            0: [torch.tensor([0]), torch.tensor([1.0])],
+            1: [torch.tensor([0, 1]), torch.tensor([0.5, 0.5])],
+        },
+    },
+    {
+        "partition_id": 0,
+        "central_nodes": torch.tensor([1]),
+        "graph_idx": torch.tensor([7, 8, 9]),
+        "edge_index": torch.tensor([[0, 1], [1, 2]]),
+        "num_nodes": 3,
+        "num_edges": 2,
+        "label_info": {
+            0: [torch.tensor([2, 1]), torch.tensor([0.25, 0.75])],
+            1: [torch.tensor([0]), torch.tensor([1.0])],
+        },
+    },
+    # A single node without neighbours, and without any label 0 users
+    {
+        "partition_id": 2,
+        "central_nodes": torch.tensor([2]),
+        "graph_idx": torch.tensor([4]),
+        "edge_index": torch.zeros((2, 0), dtype=torch.long),
+        "num_nodes": 1,
+        "num_edges": 0,
+        "label_info": {
+            0: [torch.zeros((0,), dtype=torch.long), torch.zeros((0,))],
+            1: [torch.tensor([0]), torch.tensor([1.0])],
+        },
+    },
+]
+
+
+def aggregate(tmp_path, batch_n, batch):
+    for central_id, subgraph in enumerate(SUBGRAPHS):
+        torch.save(obj=subgraph, f=tmp_path / f"subgraph_{central_id}.pt")
+
+    dataset = SimpleNamespace(neighbourhood_dir=tmp_path, labels=LABELS)
+
+    return BatchedKHopUserNeighbourhood._aggregate_subgraphs(dataset, batch_n, batch)
+
+
+def assert_batched_equal(batched_subgraphs, expected):
+    assert batched_subgraphs.keys() == expected.keys()
+    for k, v in expected.items():
+        if isinstance(v, torch.Tensor):
+            assert batched_subgraphs[k].dtype == v.dtype, k
+            assert torch.equal(batched_subgraphs[k], v), k
+        else:
+            assert batched_subgraphs[k] == v, k
+
+
+def test_aggregate_subgraphs_offsets_nodes_edges_and_labels(tmp_path):
+    batched_subgraphs = aggregate(tmp_path, 3, [1, 2, 0])
+
+    assert_batched_equal(
+        batched_subgraphs,
+        {
+            "batch_n": torch.tensor(3),
+            "partition_id": [0, 2, 1],
+            "batch_ptr": torch.tensor([0, 3, 4]),
+            "central_nodes": torch.tensor([1, 2, 0]),
+            "graph_idx": torch.tensor([7, 8, 9, 4, 5, 6]),
+            "edge_index": torch.tensor([[0, 1, 4], [1, 2, 5]]),
+            "num_nodes": torch.tensor(6),
+            "num_edges": torch.tensor(3),
+            # Padded to the most labels in any subgraph
+            "label_0_locs": torch.tensor([[2, 1], [-1, -1], [4, -1]]),
+            "label_0_probs": torch.tensor([[0.25, 0.75], [0.0, 0.0], [1.0, 0.0]]),
+            "label_1_locs": torch.tensor([[0, -1], [3, -1], [4, 5]]),
+            "label_1_probs": torch.tensor([[1.0, 0.0], [1.0, 0.0], [0.5, 0.5]]),
+        },
+    )
+
+
+def test_aggregate_single_subgraph(tmp_path):
+    batched_subgraphs = aggregate(tmp_path, 0, [2])
+
+    assert_batched_equal(
+        batched_subgraphs,
+        {
+            "batch_n": torch.tensor(0),
+            "partition_id": [2],
+            "batch_ptr": torch.tensor([0]),
+            "central_nodes": torch.tensor([2]),
+            "graph_idx": torch.tensor([4]),
+            "edge_index": torch.zeros((2, 0), dtype=torch.long),
+            "num_nodes": torch.tensor(1),
+            "num_edges": torch.tensor(0),
+            "label_0_locs": torch.zeros((1, 0), dtype=torch.long),
+            "label_0_probs": torch.zeros((1, 0)),
+            "label_1_locs": torch.tensor([[0]]),
+            "label_1_probs": torch.tensor([[1.0]]),
+        },
+    )
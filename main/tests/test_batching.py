@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from data_loading.batched_user_neighbourhood import assign_to_batches
+
+
+def batch_lists(node_ids, partition_ids, batch_size):
+    batch_offsets, batch_members = assign_to_batches(
+        np.array(node_ids, dtype=np.int64),
+        np.array(partition_ids, dtype=np.int64),
+        batch_size=batch_size,
+        logger=lambda _: None,
+    )
+
+    return [
+        batch_members[start:end].tolist()
+        for start, end in zip(batch_offsets[:-1], batch_offsets[1:])
+    ]
+
+
+@pytest.mark.parametrize(
+    "node_ids,partition_ids,batch_size,expected",
+    [
+        ([], [], 2, []),
+        # A single partition gives one sample per batch, before folding
+        ([10, 11, 12], [0, 0, 0], 1, [[10], [11], [12]]),
+        ([10, 11, 12], [0, 0, 0], 2, [[10, 12], [11]]),
+        # Samples are ranked within their partition, keeping the original order
+        ([0, 1, 2, 3, 4], [0, 1, 0, 1, 0], 2, [[0, 1], [2, 3], [4]]),
+        # The trailing batches fill up the first ones, last batch first
+        ([0, 1, 2, 3, 4, 5], [0, 0, 0, 0, 1, 1], 3, [[0, 4, 3], [1, 5, 2]]),
+    ],
+)
+def test_assign_to_batches_small_cases(node_ids, partition_ids, batch_size, expected):
+    assert batch_lists(node_ids, partition_ids, batch_size) == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_assign_to_batches_fills_all_but_last(seed):
+    rng = np.random.default_rng(seed)
+
+    num_partitions = int(rng.integers(1, 16))
+    batch_size = int(rng.integers(num_partitions, 2 * num_partitions + 1))
+    num_samples = int(rng.integers(1, 300))
+
+    # Skewed partition sizes, to get many small trailing batches
+    partition_ids = rng.choice(
+        num_partitions, size=num_samples, p=rng.dirichlet(np.ones(num_partitions))
+    )
+    node_ids = rng.permutation(10 * num_samples)[:num_samples]
+
+    batches = batch_lists(node_ids, partition_ids, batch_size)
+
+    assert sorted(sum(batches, [])) == sorted(node_ids.tolist())
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    assert 0 < len(batches[-1]) <= batch_size
+
+
+def test_assign_to_batches_rejects_oversized_batches():
+    with pytest.raises(ValueError):
+        batch_lists([0, 1, 2, 3], [0, 1, 2, 3], batch_size=2)
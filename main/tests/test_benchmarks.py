@@ -0,0 +1,56 @@
+from pathlib import Path
+
+from hydra import compose, initialize_config_dir
+from omegaconf import OmegaConf
+
+from benchmarks.run import run_benchmarks, save_results
+from utils.io import load_json_file
+
+CONFIG_DIR = str(Path(__file__).resolve().parents[1] / "config")
+
+STAGES = [
+    "generate_adjacency_matrix",
+    "build_graph",
+    "split_graph",
+    "generate_batches",
+    "generate_subgraph",
+    "collate_fn_train",
+    "SparseGATLayer.forward",
+    "maml_step",
+    "protomaml_step",
+]
+
+
+def test_benchmark_smoke(tmp_path):
+    with initialize_config_dir(config_dir=CONFIG_DIR, version_base=None):
+        args = compose(
+            config_name="benchmark",
+            overrides=[
+                "benchmark.num_docs=300",
+                "benchmark.num_users=1000",
+                "benchmark.feature_dim=16",
+                "benchmark.repeats=1",
+                "benchmark.num_subgraphs=4",
+                "benchmark.num_episodes=2",
+                "benchmark.train_steps=2",
+                f"benchmark.data_dir={tmp_path / 'data'}",
+                f"benchmark.output_dir={tmp_path / 'results'}",
+                "model.hid_dim=16",
+                "model.fc_dim=8",
+                "structure.max_nodes_per_subgraph=256",
+                # Query sets are rounded to multiples of all shots
+                "shots=[4]",
+            ],
+        )
+
+    args = OmegaConf.to_container(args, resolve=True)
+
+    results = run_benchmarks(args)
+
+    assert set(STAGES) <= results["stages"].keys()
+    for stage in STAGES:
+        assert results["stages"][stage]["repeats"] > 0, stage
+        assert results["stages"][stage]["median"] > 0, stage
+
+    output_file = save_results(results, args["benchmark"]["output_dir"])
+    assert load_json_file(output_file)["stages"].keys() == results["stages"].keys()
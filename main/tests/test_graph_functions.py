@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+from utils.graph_functions import count_two_hop_reach
+
+
+def dense_two_hop_reach(edge_index, num_nodes, source_nodes, target_mask):
+    # Reference on the dense adjacency, with A[i, j] = 1 for each edge (i, j)
+    adj = torch.zeros((num_nodes, num_nodes))
+    adj[edge_index[0], edge_index[1]] = 1
+
+    reach = (adj @ adj).T[source_nodes][:, target_mask] > 0
+
+    return reach.sum(dim=1).float()
+
+
+# Edges 0 -> 1 -> 2, and 3 -> 4 -> 2, node 5 has no neighbours
+EDGE_INDEX = torch.tensor([[0, 1, 3, 4], [1, 2, 4, 2]])
+
+
+@pytest.mark.parametrize(
+    "source_nodes,target_mask,expected",
+    [
+        # Node 2 is reached from 0 and 3, nothing reaches 0 or 5 in two hops
+        ([2, 0, 5], [True] * 6, [2.0, 0.0, 0.0]),
+        # Only targets count towards the reach
+        ([2], [False, True, True, True, True, True], [1.0]),
+        ([], [True] * 6, []),
+    ],
+)
+@pytest.mark.parametrize("max_work", [None, 1])
+def test_count_two_hop_reach_small_graph(source_nodes, target_mask, expected, max_work):
+    counts = count_two_hop_reach(
+        EDGE_INDEX,
+        num_nodes=6,
+        source_nodes=torch.tensor(source_nodes, dtype=torch.long),
+        target_mask=torch.tensor(target_mask),
+        max_work=max_work,
+    )
+
+    assert counts.dtype == torch.float32
+    assert counts.tolist() == expected
+
+
+def test_count_two_hop_reach_counts_distinct_nodes():
+    # Two 2-hop walks from 0 to 3, via 1 and via 2
+    edge_index = torch.tensor([[0, 0, 1, 2], [1, 2, 3, 3]])
+
+    counts = count_two_hop_reach(
+        edge_index,
+        num_nodes=4,
+        source_nodes=torch.tensor([3]),
+        target_mask=torch.ones((4,), dtype=torch.bool),
+    )
+
+    assert counts.tolist() == [1.0]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("max_work", [None, 1, 7])
+def test_count_two_hop_reach_matches_dense(seed, max_work):
+    rng = torch.Generator().manual_seed(seed)
+
+    num_nodes = int(torch.randint(2, 200, (1,), generator=rng))
+    num_edges = int(torch.randint(0, 4 * num_nodes, (1,), generator=rng))
+
+    edge_index = torch.randint(0, num_nodes, (2, num_edges), generator=rng)
+
+    source_nodes = torch.where(torch.rand((num_nodes,), generator=rng) < 0.3)[0]
+    target_mask = torch.arange(num_nodes) > num_nodes // 4
+
+    counts = count_two_hop_reach(
+        edge_index,
+        num_nodes=num_nodes,
+        source_nodes=source_nodes,
+        target_mask=target_mask,
+        max_work=max_work,
+    )
+
+    assert torch.equal(
+        counts, dense_two_hop_reach(edge_index, num_nodes, source_nodes, target_mask)
+    )
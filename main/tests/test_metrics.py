@@ -0,0 +1,198 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import auc, precision_recall_curve
+from torchmetrics.functional.classification import (
+    multiclass_accuracy,
+    multiclass_cohen_kappa,
+    multiclass_f1_score,
+    multiclass_matthews_corrcoef,
+    multiclass_precision,
+    multiclass_recall,
+)
+
+from utils.metrics import (
+    compute_aupr_metrics,
+    compute_batched_aupr_metrics,
+    compute_clf_metrics,
+)
+
+
+def sklearn_aupr_metrics(probs, gt, num_classes, ignore_index=-1):
+    # Reference on sklearn's exact PR curves
+    probs = probs[gt != ignore_index].numpy()
+    gt = gt[gt != ignore_index].numpy()
+
+    pr_analysis = dict()
+    for l in range(num_classes):
+        precision, recall, _ = precision_recall_curve(gt, probs[:, l], pos_label=l)
+        pr_analysis[f"aupr_{l}"] = auc(recall, precision)
+
+        # Precision and recall gains, over the recall gains in [0, 1]
+        prevalence = (gt == l).mean()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision_gain = (precision - prevalence) / ((1 - prevalence) * precision)
+            recall_gain = (recall - prevalence) / ((1 - prevalence) * recall)
+
+        above_0 = np.clip(recall_gain, -1, 1) >= 0
+        pr_analysis[f"auprg_{l}"] = (
+            auc(recall_gain[above_0], np.clip(precision_gain[above_0], -1, 1))
+            if above_0.sum() > 1
+            else -1.0
+        )
+
+    pr_analysis["macro_aupr"] = np.mean(
+        [pr_analysis[f"aupr_{l}"] for l in range(num_classes)]
+    )
+    pr_analysis["macro_auprg"] = np.mean(
+        [pr_analysis[f"auprg_{l}"] for l in range(num_classes)]
+    )
+
+    return pr_analysis
+
+
+def random_episodes(seed, num_episodes, num_nodes, num_classes):
+    rng = torch.Generator().manual_seed(seed)
+
+    # Coarse probabilities, such that many scores are tied
+    logits = torch.randint(0, 5, (num_episodes, num_nodes, num_classes), generator=rng)
+    probs = torch.softmax(logits.float(), dim=-1)
+
+    gt = torch.randint(0, num_classes, (num_episodes, num_nodes), generator=rng)
+
+    # Every episode ignores some nodes, but keeps all classes present
+    ignored = torch.rand((num_episodes, num_nodes), generator=rng) < 0.3
+    ignored[:, :num_classes] = False
+    gt[:, :num_classes] = torch.arange(num_classes)
+    gt = gt.masked_fill(ignored, -1)
+
+    return probs, gt
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("num_classes", [2, 3])
+def test_batched_aupr_matches_sklearn(seed, num_classes):
+    num_episodes = 8
+    probs, gt = random_episodes(seed, num_episodes, 40, num_classes)
+
+    pr_analysis = compute_batched_aupr_metrics(probs, gt, num_classes=num_classes)
+
+    for episode in range(num_episodes):
+        expected = sklearn_aupr_metrics(probs[episode], gt[episode], num_classes)
+
+        assert pr_analysis.keys() == expected.keys()
+        for k, v in expected.items():
+            assert pr_analysis[k][episode].item() == pytest.approx(v, abs=1e-5), k
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_single_episode_aupr_matches_sklearn(seed):
+    probs, gt = random_episodes(seed, 1, int(5 + 10 * seed), 2)
+
+    pr_analysis = compute_aupr_metrics(probs[0], gt[0], num_classes=2)
+    expected = sklearn_aupr_metrics(probs[0], gt[0], num_classes=2)
+
+    for k, v in expected.items():
+        assert pr_analysis[k].item() == pytest.approx(v, abs=1e-5), k
+
+
+@pytest.mark.parametrize(
+    "scores,gt,aupr,auprg",
+    [
+        # Perfect ranking
+        ([0.9, 0.8, 0.3, 0.1], [1, 1, 0, 0], 1.0, 1.0),
+        # A single run of tied scores, the only point above zero recall gain
+        ([0.5, 0.5, 0.5, 0.5], [1, 0, 1, 0], 0.75, -1.0),
+        # Ignored nodes do not count, even with the highest score
+        ([0.99, 0.9, 0.8, 0.3, 0.1], [-1, 1, 1, 0, 0], 1.0, 1.0),
+    ],
+)
+def test_aupr_small_cases(scores, gt, aupr, auprg):
+    scores = torch.tensor(scores)
+    probs = torch.stack([1 - scores, scores], dim=-1)
+
+    pr_analysis = compute_aupr_metrics(probs, torch.tensor(gt), num_classes=2)
+
+    assert pr_analysis["aupr_1"].item() == pytest.approx(aupr)
+    assert pr_analysis["auprg_1"].item() == pytest.approx(auprg)
+
+
+def torchmetrics_clf_metrics(preds, gt, num_classes, ignore_index=-1):
+    # The torchmetrics functional calls the confusion matrix replaced
+    kwargs = dict(num_classes=num_classes, ignore_index=ignore_index)
+
+    f1 = multiclass_f1_score(preds, gt, average="none", **kwargs)
+
+    class_prevalence = torch.bincount(gt[gt != ignore_index], minlength=num_classes)
+    class_prevalence = class_prevalence / class_prevalence.sum()
+    f1_gain = torch.clip(
+        (f1 - class_prevalence) / ((1 - class_prevalence) * f1), min=-1.0, max=1.0
+    )
+
+    metrics = {
+        "accuracy": multiclass_accuracy(preds, gt, average="macro", **kwargs),
+        "f1_micro": multiclass_f1_score(preds, gt, average="micro", **kwargs),
+        "f1_macro": multiclass_f1_score(preds, gt, average="macro", **kwargs),
+        "mcc": multiclass_matthews_corrcoef(preds, gt, **kwargs),
+        "f1_gain_macro": f1_gain.mean(),
+        "cohens_kappa": multiclass_cohen_kappa(preds, gt, **kwargs),
+    }
+    for name, scores in [
+        ("precision", multiclass_precision(preds, gt, average="none", **kwargs)),
+        ("recall", multiclass_recall(preds, gt, average="none", **kwargs)),
+        ("f1", f1),
+        ("f1_gain", f1_gain),
+    ]:
+        metrics.update({f"{name}_{c}": score for c, score in enumerate(scores)})
+
+    return metrics
+
+
+CLF_CASES = {
+    # Degenerate confusion matrices
+    "all_wrong_one_class_predicted": ([0, 0, 0], [0, 1, 1], 2),
+    "all_correct_one_class": ([1, 1, 1], [1, 1, 1], 2),
+    "all_wrong_binary": ([1, 1, 0], [0, 0, 1], 2),
+    "all_correct_binary": ([0, 1, 1], [0, 1, 1], 2),
+    "one_class_present": ([0, 1, 0, 1], [1, 1, 1, 1], 2),
+    "class_never_seen": ([0, 1, 1, 0], [0, 1, 0, 0], 3),
+    "all_ignored_but_one": ([1, 0, 1], [-1, 0, -1], 2),
+    # Regular confusion matrices
+    "binary": ([0, 1, 1, 0, 1, 0], [0, 1, 0, 0, 1, 1], 2),
+    "multiclass": ([0, 2, 1, 2, 0, 1, 2], [0, 1, 1, 2, 2, 1, 0], 3),
+}
+
+
+@pytest.mark.parametrize("case", CLF_CASES.keys())
+def test_clf_metrics_match_torchmetrics(case):
+    preds, gt, num_classes = CLF_CASES[case]
+    preds, gt = torch.tensor(preds), torch.tensor(gt)
+
+    metrics = compute_clf_metrics(preds, gt, num_classes=num_classes)
+    expected = torchmetrics_clf_metrics(preds, gt, num_classes=num_classes)
+
+    # Newer torchmetrics fill in some undefined binary MCCs, the pinned 0.11 and
+    # the confusion matrix both return zero
+    valid = gt != -1
+    if len(gt[valid].unique()) < 2 or len(preds[valid].unique()) < 2:
+        expected["mcc"] = torch.tensor(0.0)
+
+    assert metrics.keys() == expected.keys()
+    for k, v in expected.items():
+        assert metrics[k].item() == pytest.approx(v.item(), abs=1e-6, nan_ok=True), k
+
+
+def test_clf_metrics_hand_checked():
+    # One correct negative, two positives both missed
+    metrics = compute_clf_metrics(
+        torch.tensor([0, 0, 0]), torch.tensor([0, 1, 1]), num_classes=2
+    )
+
+    assert metrics["precision_0"].item() == pytest.approx(1 / 3)
+    assert metrics["recall_0"].item() == 1.0
+    assert metrics["precision_1"].item() == 0.0
+    assert metrics["recall_1"].item() == 0.0
+    assert metrics["accuracy"].item() == 0.5
+    assert metrics["f1_micro"].item() == pytest.approx(1 / 3)
+    assert metrics["mcc"].item() == 0.0
+    assert metrics["cohens_kappa"].item() == 0.0
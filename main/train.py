@@ -157,16 +157,12 @@ def train(args: DictConfig):
     val_loader = get_dataloader(args=args, split="val", **args["data_loading"])
 
     # Figure out the dimensionality of the compressed features
-    compressed_size = (
-        PostProcessing(
-            args["data"],
-            cur_fold=args["fold"],
-            version=args["version"],
-            processed_or_structured="processed",
-        )
-        .load_file("feature_extractor")
-        .compressed_size
-    )
+    compressed_size = PostProcessing(
+        args["data"],
+        cur_fold=args["fold"],
+        version=args["version"],
+        processed_or_structured="processed",
+    ).load_file("feature_extractor_hparams")["compressed_size"]
 
     print("\nInferring input feature dimensionality from feature extractor.")
     print(compressed_size)
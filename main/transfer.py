@@ -11,16 +11,20 @@ import hydra
 from omegaconf import OmegaConf
 import datasets
 import torch
-from torch.utils.data import DataLoader
 import pytorch_lightning as pl
 from tqdm import tqdm
 
 from data_prep.graph_io import GraphIO
 from data_prep.content_processing import ContentProcessor
 from data_prep.post_processing import PostProcessing
-from data_prep.post_processing.feature_extraction import FeatureExtractorDataset
+from data_prep.post_processing.feature_extraction import (
+    FeatureExtractorDataset,
+    get_feature_extraction_loader,
+    to_dataset_order,
+)
 from data_loading.get_loader import get_dataset, get_dataloader
 from models import GatNonEpisodic, GatMAML, GatPrototypical
+from models.utils import run_validation
 from utils.logging import get_results_dir
 from utils.graph_functions import avg_pool_doc_neighbours
 
@@ -281,7 +285,9 @@ def transfer(args):
 
         # Re-tokenize the transfer data, but now using the origin data's tokenizer
         transfer_data = transfer_content_processor.load_file("doc_dataset")
-        transfer_data.map(lambda x: tokenizer(x["raw_text"]))
+        transfer_data = transfer_content_processor.tokenize_documents(
+            transfer_data, tokenizer
+        )
 
         # ==============================================================================
         # Feature extraction
@@ -328,11 +334,8 @@ def transfer(args):
         feature_extractor.eval()
 
         # Compression ==================================================================
-        loader = DataLoader(
-            transfer_doc_dataset,
-            batch_size=args["feature_extraction"]["batch_size"],
-            collate_fn=transfer_doc_dataset.collate_fn,
-            shuffle=False,
+        loader = get_feature_extraction_loader(
+            args, transfer_doc_dataset, shuffle=False
         )
 
         prog_bar_updates = max(len(loader) // args["feature_extraction"]["prog_bar"], 1)
@@ -361,9 +364,12 @@ def transfer(args):
                 pbar.update(i - prev_i)
                 prev_i = i
 
-        node_ids_storage = torch.cat(node_ids_storage, dim=0)
-        embeddings_storage = torch.cat(embeddings_storage, dim=0)
-        targets_storage = torch.cat(targets_storage, dim=0)
+        # Positions are looked up through `fold_idx_to_dataset_idx_mapping`
+        node_ids_storage = to_dataset_order(loader, torch.cat(node_ids_storage, dim=0))
+        embeddings_storage = to_dataset_order(
+            loader, torch.cat(embeddings_storage, dim=0)
+        )
+        targets_storage = to_dataset_order(loader, torch.cat(targets_storage, dim=0))
 
         # ==========================================================================
         # FINAL DATA CONVERSION & STRUCTURING
@@ -705,7 +711,7 @@ def transfer(args):
                     **args["data_loading"],
                 )
 
-                val_results = trainer.validate(model, val_loader, verbose=False)[0]
+                val_results = run_validation(args, trainer, model, val_loader)
                 dump_results(
                     args | {"fold": fold, "version": version},
                     prefix=model.test_prefix,
@@ -723,7 +729,7 @@ def transfer(args):
                     **args["data_loading"],
                 )
 
-                test_results = trainer.validate(model, test_loader, verbose=False)[0]
+                test_results = run_validation(args, trainer, model, test_loader)
                 dump_results(
                     args | {"fold": fold, "version": version},
                     prefix=model.test_prefix,
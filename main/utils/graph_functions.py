@@ -1,3 +1,5 @@
+import numpy as np
+import scipy.sparse as sp
 import torch
 from torch import Tensor
 from torch_geometric.typing import SparseTensor
@@ -98,3 +100,95 @@ def avg_pool_doc_neighbours(graph):
         graph.x[user_node] = graph.x[incident_document_nodes].mean(dim=(0,))
 
     return graph
+
+
+def receptive_field(node_idx, edge_index, num_nodes: int, num_hops: int):
+    """
+    Gathers the `num_hops` receptive field of `node_idx` into a compact graph.
+    Messages flow from `edge_index[1]` to `edge_index[0]`, as in `SparseGATLayer`.
+
+    Only edges pointing into nodes within `num_hops - 1` hops are kept. The
+    outputs of a `num_hops` deep message passing network on the compact graph
+    match those on the full graph for the nodes in `node_idx` only.
+
+    Returns the node subset, the relabelled edge index and the location of
+    `node_idx` in the subset.
+
+    """
+    in_field = torch.zeros(num_nodes, dtype=torch.bool, device=edge_index.device)
+    in_field[node_idx] = True
+
+    edge_mask = torch.zeros_like(edge_index[0], dtype=torch.bool)
+
+    for _ in range(num_hops):
+        # Add all edges pointing into the current frontier, and their sources
+        edge_mask = in_field[edge_index[0]]
+        in_field[edge_index[1][edge_mask]] = True
+
+    subset = torch.where(in_field)[0]
+
+    relabel = torch.full(
+        (num_nodes,), fill_value=-1, dtype=torch.long, device=edge_index.device
+    )
+    relabel[subset] = torch.arange(subset.shape[0], device=edge_index.device)
+
+    sub_edge_index = relabel[edge_index[:, edge_mask]]
+    mapping = relabel[node_idx]
+
+    return subset, sub_edge_index, mapping
+
+
+def count_two_hop_reach(
+    edge_index, num_nodes: int, source_nodes, target_mask, max_work: int = None
+):
+    """
+    Counts, for each node in `source_nodes`, the number of distinct nodes in
+    `target_mask` reachable by a 2-hop walk, i.e. the non-zeros of `A @ A`.
+    Here `A[i, j] = 1` for each edge `(i, j)` in `edge_index`.
+
+    Uses boolean (OR) semantics, so walks are never counted twice. Sources are
+    processed in chunks, such that the 2-hop pairs held in memory at any time
+    stay bounded by `max_work`, by default the number of edges.
+
+    Returns a float tensor of counts, aligned with `source_nodes`.
+
+    """
+    edge_index = edge_index.cpu().numpy()
+    source_nodes = source_nodes.cpu().numpy()
+    target_mask = target_mask.cpu().numpy()
+
+    num_edges = edge_index.shape[1]
+    if max_work is None:
+        max_work = max(num_edges, 1)
+
+    # Transposed, such that each source's 2-hop reach is a row
+    adj_t = sp.csr_matrix(
+        (np.ones(num_edges, dtype=bool), (edge_index[1], edge_index[0])),
+        shape=(num_nodes, num_nodes),
+    )
+
+    # Upper bound on the number of 2-hop pairs for each source
+    out_degree = np.diff(adj_t.indptr)
+    work = adj_t[source_nodes] @ out_degree
+
+    counts = np.zeros(source_nodes.shape[0], dtype=np.float32)
+
+    chunk_start = 0
+    while chunk_start < source_nodes.shape[0]:
+        # Largest chunk within the budget, but at least one source
+        chunk_end = np.searchsorted(
+            np.cumsum(work[chunk_start:]), max_work, side="right"
+        )
+        chunk_end = chunk_start + max(chunk_end, 1)
+
+        reach = adj_t[source_nodes[chunk_start:chunk_end]] @ adj_t
+        reach.eliminate_zeros()
+
+        rows = np.repeat(np.arange(reach.shape[0]), np.diff(reach.indptr))
+        counts[chunk_start:chunk_end] = np.bincount(
+            rows[target_mask[reach.indices]], minlength=reach.shape[0]
+        )
+
+        chunk_start = chunk_end
+
+    return torch.from_numpy(counts)
@@ -1,176 +1,356 @@
 import math
 from collections import defaultdict
 
-import numpy as np
 import torch
-from torchmetrics.functional.classification import (
-    multiclass_confusion_matrix,
-    multiclass_accuracy,
-    multiclass_precision,
-    multiclass_recall,
-    multiclass_f1_score,
-    matthews_corrcoef,
-    multiclass_cohen_kappa,
-)
 import scipy.stats as stats
-from sklearn.metrics import precision_recall_curve, auc
+
+
+def _safe_divide(num, denom):
+    # Zero wherever the denominator is zero, like torchmetrics
+    return torch.where(denom != 0, num / torch.where(denom != 0, denom, 1), 0.0)
+
+
+class ConfusionMatrix:
+    """
+    Accumulates a (num_classes, num_classes) confusion matrix, with rows the
+    true class and columns the predicted class. All classification metrics are
+    derived from it, so each update is a single `bincount` over the samples.
+
+    Matches the torchmetrics functional metrics (0.11), with macro averages
+    ignoring classes that are neither present nor predicted, and MCC zero
+    whenever it is undefined.
+
+    """
+
+    def __init__(self, num_classes: int, ignore_index: int = -1):
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+
+        self.confmat = None
+
+    def reset(self):
+        self.confmat = None
+
+    def update(self, preds, gt):
+        valid = gt != self.ignore_index
+
+        confmat = torch.bincount(
+            gt[valid] * self.num_classes + preds[valid],
+            minlength=self.num_classes**2,
+        ).view(self.num_classes, self.num_classes)
+
+        if self.confmat is None:
+            self.confmat = confmat
+        else:
+            self.confmat = self.confmat + confmat
+
+        return self
+
+    def compute(self, prefix: str = ""):
+        confmat = self.confmat.double()
+
+        total = confmat.sum()
+        true_counts = confmat.sum(dim=1)
+        pred_counts = confmat.sum(dim=0)
+
+        tp = torch.diagonal(confmat)
+        fp = pred_counts - tp
+        fn = true_counts - tp
+
+        # Per-class metrics ====================================================
+        precision = _safe_divide(tp, tp + fp)
+        recall = _safe_divide(tp, tp + fn)
+        f1 = _safe_divide(2 * tp, 2 * tp + fp + fn)
+
+        class_prevalence = true_counts / total
+        f1_gain = torch.clip(
+            (f1 - class_prevalence) / ((1 - class_prevalence) * f1),
+            min=-1.0,
+            max=1.0,
+        )
+
+        metrics = dict()
+        for name, scores in [
+            ("precision", precision),
+            ("recall", recall),
+            ("f1", f1),
+            ("f1_gain", f1_gain),
+        ]:
+            metrics.update(
+                {
+                    f"{prefix}{name}_{c}": score.float()
+                    for c, score in enumerate(scores.unbind())
+                }
+            )
+
+        # Aggregated metrics ===================================================
+        # Classes without any samples or predictions do not count to the average
+        present = (tp + fp + fn) > 0
+        accuracy = _safe_divide(recall[present].sum(), present.sum())
+        f1_macro = _safe_divide(f1[present].sum(), present.sum())
+        f1_micro = _safe_divide(tp.sum(), total)
+
+        # Multiclass MCC
+        cov_ytyp = tp.sum() * total - torch.sum(true_counts * pred_counts)
+        cov_ypyp = total**2 - torch.sum(pred_counts**2)
+        cov_ytyt = total**2 - torch.sum(true_counts**2)
+        mcc = _safe_divide(cov_ytyp, torch.sqrt(cov_ypyp * cov_ytyt))
+
+        # Agreement beyond chance
+        observed = f1_micro
+        expected = _safe_divide(torch.sum(true_counts * pred_counts), total**2)
+        cohens_kappa = (observed - expected) / (1 - expected)
+
+        metrics.update(
+            {
+                f"{prefix}accuracy": accuracy.float(),
+                f"{prefix}f1_micro": f1_micro.float(),
+                f"{prefix}f1_macro": f1_macro.float(),
+                f"{prefix}mcc": mcc.float(),
+                f"{prefix}f1_gain_macro": f1_gain.mean().float(),
+                f"{prefix}cohens_kappa": cohens_kappa.float(),
+            }
+        )
+
+        return metrics
 
 
 def compute_clf_metrics(
     preds, gt, num_classes: int, prefix: str = "", ignore_index: int = -1
 ):
-    # Perhaps not the most efficient way to do this
-    # But guaranteed to be correct...
-    metrics = dict()
-
-    # Per-class metrics ====================================================
-    precision = multiclass_precision(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        average="none",
-        ignore_index=ignore_index,
-    )
-    recall = multiclass_recall(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        average="none",
-        ignore_index=ignore_index,
-    )
-    f1 = multiclass_f1_score(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        average="none",
-        ignore_index=ignore_index,
-    )
+    confmat = ConfusionMatrix(num_classes=num_classes, ignore_index=ignore_index)
 
-    metrics.update(
-        {
-            f"{prefix}precision_{c}": score.squeeze().float()
-            for c, score in enumerate(precision.split(1))
-        }
-    )
-    metrics.update(
-        {
-            f"{prefix}recall_{c}": score.squeeze().float()
-            for c, score in enumerate(recall.split(1))
-        }
-    )
-    metrics.update(
-        {
-            f"{prefix}f1_{c}": score.squeeze().float()
-            for c, score in enumerate(f1.split(1))
-        }
-    )
+    return confmat.update(preds, gt).compute(prefix=prefix)
 
-    class_prevalence = torch.bincount(gt[gt != ignore_index])
-    class_prevalence = class_prevalence / class_prevalence.sum()
-    f1_gain = torch.clip(
-        (f1 - class_prevalence) / ((1 - class_prevalence) * f1),
-        min=-1.0,
-        max=1.0
-    )
-    metrics.update(
-        {
-            f"{prefix}f1_gain_{c}": score.squeeze().float()
-            for c, score in enumerate(f1_gain.split(1))
-        }
-    )
 
-    # Aggregated metrics ===================================================
-    accuracy = multiclass_accuracy(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        average="macro",
-        ignore_index=ignore_index,
-    )
-    f1_micro = multiclass_f1_score(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        average="micro",
-        ignore_index=ignore_index,
-    )
-    f1_macro = multiclass_f1_score(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        average="macro",
-        ignore_index=ignore_index,
-    )
-    mcc = matthews_corrcoef(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        task="multiclass",
-        ignore_index=ignore_index,
-    )
-    cohens_kappa = multiclass_cohen_kappa(
-        preds=preds,
-        target=gt,
-        num_classes=num_classes,
-        ignore_index=ignore_index,
-    )
-    metrics.update(
-        {
-            f"{prefix}accuracy": accuracy.float(),
-            f"{prefix}f1_micro": f1_micro.float(),
-            f"{prefix}f1_macro": f1_macro.float(),
-            f"{prefix}mcc": mcc.float(),
-            f"{prefix}f1_gain_macro": f1_gain.mean().float(),
-            f"{prefix}cohens_kappa": cohens_kappa.float(),
-        }
+def _auc(x, y, mask=None):
+    """
+    Trapezoidal area under (C, T) curves, with `x` non-decreasing along the
+    last dimension. Only segments between consecutive points in `mask` count.
+
+    """
+    segments = torch.diff(x, dim=-1) * (y[..., 1:] + y[..., :-1]) / 2
+
+    if mask is not None:
+        segments = torch.where(mask[..., 1:] & mask[..., :-1], segments, 0.0)
+
+    return segments.sum(dim=-1)
+
+
+def _pr_analysis(
+    precision, recall, prevalence, distinct, num_classes: int, prefix: str = ""
+):
+    """
+    AUPR and AUPRG (Flach & Kull) from (..., C, T) PR curves, ordered by
+    non-decreasing recall, and the (..., C) class prevalences. Repeated points
+    are allowed, but only `distinct` points count towards the AUPRG minimum.
+
+    """
+    pr_analysis = dict()
+
+    # Standard PR analysis
+    aupr = _auc(recall, precision)
+
+    # Flach & Kull PR Analysis
+    prevalence = prevalence[..., None]
+    precision_gain = (precision - prevalence) / ((1 - prevalence) * precision)
+    recall_gain = (recall - prevalence) / ((1 - prevalence) * recall)
+
+    precision_gain = torch.clip(precision_gain, min=-1, max=1)
+    recall_gain = torch.clip(recall_gain, min=-1, max=1)
+
+    # AUPRG over 0 to 1 on recall
+    above_0 = recall_gain >= 0
+    auprg = torch.where(
+        (above_0 & distinct).sum(dim=-1) > 1,
+        _auc(recall_gain, precision_gain, mask=above_0),
+        -1.0,
     )
 
-    return metrics
+    for l in range(num_classes):
+        pr_analysis[f"{prefix}aupr_{l}"] = aupr[..., l]
+        pr_analysis[f"{prefix}auprg_{l}"] = auprg[..., l]
 
+    pr_analysis[f"{prefix}macro_aupr"] = aupr.mean(dim=-1)
+    pr_analysis[f"{prefix}macro_auprg"] = auprg.mean(dim=-1)
 
-def compute_aupr_metrics(
+    return pr_analysis
+
+
+class BinnedPRCurve:
+    """
+    Streaming estimate of the one-vs-rest PR curves, with thresholds fixed at
+    `num_bins` evenly spaced probabilities. Each update only adds per-bin
+    positive and negative counts, the curves are built once in `compute`.
+
+    Approximates `precision_recall_curve`, with an error that shrinks as the
+    number of bins grows.
+
+    """
+
+    def __init__(self, num_classes: int, num_bins: int = 1000, ignore_index: int = -1):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.ignore_index = ignore_index
+
+        self.positives = None
+        self.negatives = None
+
+    def reset(self):
+        self.positives = None
+        self.negatives = None
+
+    def update(self, probs, gt):
+        valid = gt != self.ignore_index
+        probs, gt = probs[valid], gt[valid]
+
+        bins = torch.clip((probs * self.num_bins).long(), min=0, max=self.num_bins - 1)
+        bins = bins + torch.arange(self.num_classes, device=bins.device) * self.num_bins
+
+        is_positive = gt[:, None] == torch.arange(self.num_classes, device=gt.device)
+
+        positives, negatives = [
+            torch.bincount(bins[mask], minlength=self.num_classes * self.num_bins).view(
+                self.num_classes, self.num_bins
+            )
+            for mask in [is_positive, ~is_positive]
+        ]
+
+        if self.positives is None:
+            self.positives, self.negatives = positives, negatives
+        else:
+            self.positives = self.positives + positives
+            self.negatives = self.negatives + negatives
+
+        return self
+
+    def compute(self, prefix: str = ""):
+        # Counts above each threshold, from the highest to the lowest
+        tps = self.positives.flip(-1).cumsum(-1).double()
+        fps = self.negatives.flip(-1).cumsum(-1).double()
+
+        # Prepend the (recall=0, precision=1) end point
+        tps = torch.nn.functional.pad(tps, (1, 0))
+        fps = torch.nn.functional.pad(fps, (1, 0))
+
+        # Thresholds above all probabilities have perfect precision by convention
+        precision = torch.where(tps + fps > 0, _safe_divide(tps, tps + fps), 1.0)
+        recall = _safe_divide(tps, tps[:, -1:])
+
+        prevalence = tps[:, -1] / (tps[:, -1] + fps[:, -1])
+
+        # Empty bins repeat the previous point
+        distinct = torch.nn.functional.pad(
+            (self.positives + self.negatives).flip(-1) > 0, (1, 0)
+        )
+
+        return _pr_analysis(
+            precision.float(),
+            recall.float(),
+            prevalence.float(),
+            distinct,
+            num_classes=self.num_classes,
+            prefix=prefix,
+        )
+
+
+def compute_batched_aupr_metrics(
     probs, gt, num_classes: int, prefix: str = "", ignore_index: int = -1
 ):
-    probs = probs[gt != ignore_index].numpy()
-    gt = gt[gt != ignore_index].numpy()
+    """
+    Exact AUPR and AUPRG for a batch of episodes at once, equal to those from
+    sklearn's `precision_recall_curve`.
 
-    macro_aupr = 0
-    macro_auprg = 0
-    pr_analysis = dict()
+    Takes (episodes, N, C) probabilities and (episodes, N) or (N, ) labels,
+    and returns a (episodes, ) tensor per metric.
+
+    """
+    if gt.dim() == 1:
+        gt = gt.expand(probs.shape[:-1])
+
+    valid = gt != ignore_index
+    n_valid = valid.sum(dim=-1, keepdim=True)
+
+    node_idx = torch.arange(probs.shape[1], device=probs.device)
+
+    precision, recall, prevalence, distinct = [], [], [], []
     for l in range(num_classes):
-        # Standard PR analysis
-        precision, recall, _ = precision_recall_curve(
-            y_true=gt, probas_pred=probs[:, l], pos_label=l
+        # Ignored nodes sort last and do not count towards any point
+        scores = probs[..., l].double().masked_fill(~valid, -float("inf"))
+        scores, order = torch.sort(scores, dim=-1, descending=True)
+
+        is_valid = torch.gather(valid, -1, order)
+        is_positive = torch.gather(gt == l, -1, order) & is_valid
+
+        tps = torch.cumsum(is_positive, dim=-1).double()
+        fps = torch.cumsum(is_valid & ~is_positive, dim=-1).double()
+
+        # Only the last node of a run of tied scores is a threshold
+        is_threshold = is_valid & (
+            torch.nn.functional.pad(
+                (scores[..., 1:] != scores[..., :-1]) | ~is_valid[..., 1:],
+                (0, 1),
+                value=True,
+            )
         )
-        aupr = auc(recall, precision)
 
-        pr_analysis[f"{prefix}aupr_{l}"] = torch.tensor(aupr)
-        macro_aupr += aupr
+        # Other nodes repeat the point of the threshold ending their run
+        run_end = torch.where(is_threshold | ~is_valid, node_idx, probs.shape[1])
+        run_end = torch.flip(torch.cummin(torch.flip(run_end, (-1,)), -1).values, (-1,))
 
-        # Flach & Kull PR Analysis
-        prevalence = (gt == l).mean()
+        tps = torch.gather(tps, -1, run_end)
+        fps = torch.gather(fps, -1, run_end)
 
-        with np.errstate(divide="ignore"):
-            precision_gain = (precision - prevalence) / ((1 - prevalence) * precision)
-            recall_gain = (recall - prevalence) / ((1 - prevalence) * recall)
+        n_positive = tps[..., -1:]
 
-        precision_gain = np.clip(precision_gain, a_min=-1, a_max=1)
-        recall_gain = np.clip(recall_gain, a_min=-1, a_max=1)
+        # Prepend the (recall=0, precision=1) end point
+        precision.append(
+            torch.nn.functional.pad(_safe_divide(tps, tps + fps), (1, 0), value=1.0)
+        )
+        recall.append(
+            torch.nn.functional.pad(
+                torch.where(n_positive > 0, tps / n_positive, 1.0), (1, 0)
+            )
+        )
+        prevalence.append(n_positive[..., 0] / n_valid[..., 0])
+        distinct.append(torch.nn.functional.pad(is_threshold, (1, 0)))
+
+    return _pr_analysis(
+        torch.stack(precision, dim=-2).float(),
+        torch.stack(recall, dim=-2).float(),
+        torch.stack(prevalence, dim=-1).float(),
+        torch.stack(distinct, dim=-2),
+        num_classes=num_classes,
+        prefix=prefix,
+    )
 
-        # AUPRG over 0 to 1 on recall
-        above_0 = recall_gain >= 0
-        if above_0.sum() > 1:
-            auprg = auc(recall_gain[above_0], precision_gain[above_0])
-        else:
-            auprg = -1.0
 
-        pr_analysis[f"{prefix}auprg_{l}"] = torch.tensor(auprg)
-        macro_auprg += auprg
+def compute_aupr_metrics(
+    probs,
+    gt,
+    num_classes: int,
+    prefix: str = "",
+    ignore_index: int = -1,
+    num_bins: int = None,
+):
+    # Binned estimate, linear in the number of samples
+    if num_bins is not None:
+        pr_curve = BinnedPRCurve(
+            num_classes=num_classes, num_bins=num_bins, ignore_index=ignore_index
+        )
 
-    pr_analysis[f"{prefix}macro_aupr"] = torch.tensor(macro_aupr / num_classes)
-    pr_analysis[f"{prefix}macro_auprg"] = torch.tensor(macro_auprg / num_classes)
+        return pr_curve.update(probs, gt).compute(prefix=prefix)
 
-    return pr_analysis
+    # Exact curves, as a batch of a single episode
+    pr_analysis = compute_batched_aupr_metrics(
+        probs.unsqueeze(0),
+        gt.unsqueeze(0),
+        num_classes=num_classes,
+        prefix=prefix,
+        ignore_index=ignore_index,
+    )
+
+    return {k: v.squeeze(0) for k, v in pr_analysis.items()}
 
 
 def ci_multiplier(N: int, alpha: float = 0.10):